@@ -2,9 +2,7 @@
 
 # Setup crontab
 env | grep PATH > /tmp/crontab
-echo "20 * * * * 	python /app/scripts/cron.py" >> /tmp/crontab
-echo "23 11 * * * 	python /app/scripts/tweet.py" >> /tmp/crontab
-echo "23 11 * * *       python /app/scripts/toot.py" >> /tmp/crontab
+echo "23 11 * * * 	python /app/scripts/post.py" >> /tmp/crontab
 crontab /tmp/crontab
 rm /tmp/crontab
 
@@ -22,8 +20,16 @@ if [ ! -d "/data/htdocs" ]; then
 	cp -r /app/htdocs /data/
 fi
 
-echo "Initial data load..."
-python /app/scripts/cron.py
+# Fetches all sources right away, and then each on its own interval. It is
+# started again should it ever exit.
+echo "Starting calendar daemon ..."
+(
+	while true; do
+		python /app/scripts/cron.py --daemon
+		echo "Calendar daemon exited with status $?, restarting in 60 seconds ..."
+		sleep 60
+	done
+) &
 
 # Start cron
 echo "Starting cron ..."
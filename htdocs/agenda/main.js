@@ -1,6 +1,3 @@
-var no_of_events = 15;
-var all_events = [];
-
 function pad(num, size){
 	return ('00' + num).substr(-size);
 }
@@ -29,13 +26,6 @@ function toHTML(data) {
 	return items.join( "" );
 }
 
-function sortByKey(array, key) {
-	return array.sort(function(a, b) {
-		var x = a[key]; var y = b[key];
-		return ((x < y) ? -1 : ((x > y) ? 1 : 0));
-	});
-}
-
 function filterForCurrentEvents(data) {
 	var today = new Date();
 	today.setHours(0, 0, 0, 0);
@@ -44,32 +34,11 @@ function filterForCurrentEvents(data) {
 	return event_start >= today;
 }
 
-function sourcesMergeFunction(source) {
-	return function (events) {
-		$.each(events, function (i, theevent) {
-			console.log(source);
-			theevent.source = source;
-		});
-		all_events = all_events.concat(events);
-	};
-}
-
-$.getJSON( "../data/_sources.json", function( sources ) {
-	var requests = []; // hold ajax request
-
-	$.each(sources, function(i, source) {
-	    requests.push($.getJSON("../" + source.url, sourcesMergeFunction(source.title) ));
-	});
-
-	$.when.apply($, requests).done(function () {
-
-	    console.log(all_events)
-		data = all_events.filter(filterForCurrentEvents);
-		data = sortByKey(data, "start");
-		console.log(data);
-		data = data.splice(0, no_of_events);
-		console.log(data);
-		data = toHTML(data)
-		$( data ).appendTo( "body" );
-	});
+// upcoming.json holds the next events of all sources, already sorted and
+// with the source title attached. It is only regenerated hourly though, so
+// drop events of past days here.
+$.getJSON( "../data/upcoming.json", function( data ) {
+	data = data.filter(filterForCurrentEvents);
+	data = toHTML(data)
+	$( data ).appendTo( "body" );
 });
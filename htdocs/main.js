@@ -2,6 +2,46 @@ function dateString(d) {
     return "" + d.getFullYear() + "-" + d.getMonth() + "-" + d.getDay();
 }
 
+function pad(num) {
+    return ('0' + num).slice(-2);
+}
+
+// Event source that only loads the monthly shards overlapping the range
+// FullCalendar asks for. months maps "YYYY-MM" to the shard's url.
+function shardedSource(source, months) {
+    return {
+        id: source.id,
+        color: source.color,
+        events: function (info, successCallback, failureCallback) {
+            var requests = [];
+            var month = new Date(info.start.getFullYear(), info.start.getMonth(), 1);
+            while (month < info.end) {
+                var key = month.getFullYear() + "-" + pad(month.getMonth() + 1);
+                if (months[key]) {
+                    requests.push($.getJSON(months[key]));
+                }
+                month.setMonth(month.getMonth() + 1);
+            }
+
+            Promise.all(requests).then(function (shards) {
+                // events spanning several months are in each of their shards
+                var seen = {};
+                var events = [];
+                $.each(shards, function (i, shard) {
+                    $.each(shard, function (j, event) {
+                        var key = JSON.stringify(event);
+                        if (!seen[key]) {
+                            seen[key] = true;
+                            events.push(event);
+                        }
+                    });
+                });
+                successCallback(events);
+            }, failureCallback);
+        }
+    };
+}
+
 $(document).ready(function () {
     // load available calendars via AJAX
     $.getJSON("data/_sources.json", function (data) {
@@ -14,7 +54,7 @@ $(document).ready(function () {
                 center: 'title',
                 right: 'dayGridMonth,timeGridWeek,timeGridDay'
             },
-            eventSources: data, //  Event sources from AJAX call
+            eventSources: [], //  added below, once it's known which are sharded
             firstDay: 1, // week starts on a Monday
             locale: 'de', // German locale
             eventTimeFormat: {
@@ -57,6 +97,16 @@ $(document).ready(function () {
         });
         calendar.render();
 
+        // _shards.json only exists if cron.py writes monthly shards
+        function addSources(shards) {
+            $.each(data, function (key, source) {
+                calendar.addEventSource(shards[source.id] ? shardedSource(source, shards[source.id]) : source);
+            });
+        }
+        $.getJSON("data/_shards.json").then(addSources, function () {
+            addSources({});
+        });
+
         // Render calendar legend
         var legend = [];
         $.each(data, function (key, val) {
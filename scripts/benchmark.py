@@ -0,0 +1,526 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# -------------------------------------------------------------
+#  Community Calendar
+#  Benchmarks for the cron job, run against synthetic feeds
+# -------------------------------------------------------------
+
+import os
+import sys
+import json
+import time
+import glob
+import shutil
+import tempfile
+import threading
+import tracemalloc
+import importlib.util
+from functools import partial
+from argparse import ArgumentParser
+from datetime import datetime, timedelta
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import yaml
+import eventbrite
+
+directory = os.path.dirname(os.path.realpath(__file__))
+
+# -------------------------------------------------------------
+#  Local stand-in for the feed servers and the Eventbrite API
+# -------------------------------------------------------------
+
+class FeedServer(ThreadingHTTPServer):
+    """
+    Serves the bytes in self.feeds, keyed by path, from a local port. Paths
+    below /eventbrite/ answer like the parts of the Eventbrite API cron.py
+    uses, for the organizers in self.organizers.
+    """
+    daemon_threads = True
+
+    def __init__(self):
+        ThreadingHTTPServer.__init__(self, ("127.0.0.1", 0), FeedHandler)
+        self.feeds = {}
+        self.organizers = {}
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def url(self, path):
+        return "http://127.0.0.1:%d%s" % (self.server_port, path)
+
+class FeedHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path.startswith("/eventbrite/"):
+            data = self.eventbrite(url.path.split("/")[2:], parse_qs(url.query))
+        else:
+            data = self.server.feeds.get(url.path)
+
+        if data is None:
+            self.send_error(404)
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def eventbrite(self, path, query, page_size=50):
+        if path[0] == "organizers" and path[1] in self.server.organizers:
+            events = self.server.organizers[path[1]]
+            page = int(query.get("continuation", ["0"])[0])
+            data = {
+                "events": events[page * page_size:(page + 1) * page_size],
+                "pagination": {
+                    "has_more_items": (page + 1) * page_size < len(events),
+                    "continuation": str(page + 1),
+                },
+            }
+        elif path[0] == "venues":
+            data = {
+                "name": "Venue %s" % path[1],
+                "address": {"address_1": "Street %s" % path[1], "postal_code": "80331", "city": "München"},
+            }
+        else:
+            return None
+
+        return json.dumps(data).encode("utf-8")
+
+    def log_message(self, format, *args):
+        pass
+
+# -------------------------------------------------------------
+#  Synthetic feeds
+# -------------------------------------------------------------
+
+def windowStart():
+    return datetime.now().replace(hour=18, minute=0, second=0, microsecond=0) - timedelta(days=60)
+
+def syntheticIcal(single, series, overrides, extra=()):
+    """
+    A feed of `single` one-off events spread over the window of the cron job,
+    and `series` daily events starting 60 days ago. `overrides` of the
+    occurrences of every series are moved by an hour with a RECURRENCE-ID
+    instance. The lines in `extra` are added to the calendar as they are.
+    """
+    first = windowStart()
+    stamp = "%Y%m%dT%H%M%S"
+    lines = ["BEGIN:VCALENDAR", "VERSION:2.0", "PRODID:-//community_calendar//benchmark//"]
+
+    for n in range(single):
+        start = first + timedelta(days=n * 240 / max(single, 1))
+        lines += [
+            "BEGIN:VEVENT",
+            "UID:single-%d@benchmark" % n,
+            "DTSTART;TZID=Europe/Berlin:" + start.strftime(stamp),
+            "DTEND;TZID=Europe/Berlin:" + (start + timedelta(hours=2)).strftime(stamp),
+            "SUMMARY:Event %d" % n,
+            "DESCRIPTION:Some description\\, with an escaped comma\\nand a second line",
+            "LOCATION:Somewhere %d" % n,
+            "URL:https://example.org/events/%d" % n,
+            "END:VEVENT"]
+
+    for n in range(series):
+        uid = "series-%d@benchmark" % n
+        lines += [
+            "BEGIN:VEVENT",
+            "UID:" + uid,
+            "DTSTART;TZID=Europe/Berlin:" + first.strftime(stamp),
+            "DTEND;TZID=Europe/Berlin:" + (first + timedelta(hours=2)).strftime(stamp),
+            "RRULE:FREQ=DAILY",
+            "SUMMARY:Series %d" % n,
+            "END:VEVENT"]
+
+        for day in range(overrides):
+            occurrence = first + timedelta(days=2 * day + 1)
+            lines += [
+                "BEGIN:VEVENT",
+                "UID:" + uid,
+                "RECURRENCE-ID;TZID=Europe/Berlin:" + occurrence.strftime(stamp),
+                "DTSTART;TZID=Europe/Berlin:" + (occurrence + timedelta(hours=1)).strftime(stamp),
+                "DTEND;TZID=Europe/Berlin:" + (occurrence + timedelta(hours=3)).strftime(stamp),
+                "SUMMARY:Series %d (moved)" % n,
+                "END:VEVENT"]
+
+    lines += extra
+    lines.append("END:VCALENDAR")
+    return ("\r\n".join(lines) + "\r\n").encode("utf-8")
+
+def syntheticBoundaries(today, shifts):
+    """
+    Events right at the bounds of the window of the cron job on today, and
+    on the days `shifts` days later, in the lines of VEVENTs
+    """
+    date, stamp = "%Y%m%d", "%Y%m%dT%H%M%S"
+    lines = []
+    def event(uid, start, end, *more):
+        lines.extend(["BEGIN:VEVENT", "UID:%s@benchmark" % uid, start, end] + list(more)
+                     + ["SUMMARY:Boundary %s" % uid, "END:VEVENT"])
+
+    for shift in (0,) + tuple(shifts):
+        first = today + timedelta(days=shift - 60)
+        last = today + timedelta(days=shift + 180)
+        midnight = datetime.combine(first, datetime.min.time())
+        # all day events ending on the first day of the window, and before it
+        event("ends-%d" % shift, "DTSTART;VALUE=DATE:" + (first - timedelta(days=1)).strftime(date),
+              "DTEND;VALUE=DATE:" + first.strftime(date))
+        event("ended-%d" % shift, "DTSTART;VALUE=DATE:" + (first - timedelta(days=2)).strftime(date),
+              "DTEND;VALUE=DATE:" + (first - timedelta(days=1)).strftime(date))
+        # an evening event ending at midnight when the window starts
+        event("evening-%d" % shift, "DTSTART;TZID=Europe/Berlin:" + (midnight - timedelta(hours=2)).strftime(stamp),
+              "DTEND;TZID=Europe/Berlin:" + midnight.strftime(stamp))
+        # overnight occurrences, one of them running into the window
+        event("overnight-%d" % shift, "DTSTART;TZID=Europe/Berlin:" + (midnight - timedelta(days=3, hours=2)).strftime(stamp),
+              "DTEND;TZID=Europe/Berlin:" + (midnight - timedelta(days=3, hours=-2)).strftime(stamp),
+              "RRULE:FREQ=DAILY;COUNT=6")
+        # all day events on the last day of the window, and right after it
+        event("last-%d" % shift, "DTSTART;VALUE=DATE:" + last.strftime(date),
+              "DTEND;VALUE=DATE:" + (last + timedelta(days=1)).strftime(date))
+        event("after-%d" % shift, "DTSTART;VALUE=DATE:" + (last + timedelta(days=1)).strftime(date),
+              "DTEND;VALUE=DATE:" + (last + timedelta(days=2)).strftime(date))
+
+    return lines
+
+def syntheticMovedOccurrence(today):
+    """
+    The lines of a daily series, one occurrence of which is moved from the
+    window of the cron job on today to after it
+    """
+    stamp = "%Y%m%dT%H%M%S"
+    start = datetime.combine(today - timedelta(days=70), datetime.min.time()) + timedelta(hours=10)
+    moved = start + timedelta(days=60)
+    return ["BEGIN:VEVENT", "UID:moved@benchmark",
+            "DTSTART;TZID=Europe/Berlin:" + start.strftime(stamp),
+            "DTEND;TZID=Europe/Berlin:" + (start + timedelta(hours=1)).strftime(stamp),
+            "RRULE:FREQ=DAILY;COUNT=300", "SUMMARY:Moved", "END:VEVENT",
+            "BEGIN:VEVENT", "UID:moved@benchmark",
+            "RECURRENCE-ID;TZID=Europe/Berlin:" + moved.strftime(stamp),
+            "DTSTART;TZID=Europe/Berlin:" + (moved + timedelta(days=190)).strftime(stamp),
+            "DTEND;TZID=Europe/Berlin:" + (moved + timedelta(days=190, hours=1)).strftime(stamp),
+            "SUMMARY:Moved (moved)", "END:VEVENT"]
+
+def syntheticMicrodata(count):
+    """ A page with `count` schema.org Events between unrelated markup """
+    first = windowStart()
+    items = []
+    for n in range(count):
+        start = first + timedelta(days=n * 240 / max(count, 1))
+        items.append(
+            '<div class="teaser"><p>Lorem ipsum dolor sit amet, consectetur adipiscing elit.</p>'
+            '<div itemscope itemtype="http://schema.org/Event">'
+            '<a itemprop="url" href="/events/%d"><span itemprop="name">Event %d</span></a>'
+            '<meta itemprop="startDate" content="%s">'
+            '<meta itemprop="endDate" content="%s">'
+            '<div itemprop="location" itemscope itemtype="http://schema.org/Place"><span itemprop="name">Hall %d</span></div>'
+            '</div></div>' % (n, n, start.isoformat(), (start + timedelta(hours=2)).isoformat(), n % 10))
+
+    return ("<!DOCTYPE html><html><head><title>Events</title></head><body><ul><li>Menu</li></ul>%s</body></html>"
+            % "".join(items)).encode("utf-8")
+
+def syntheticEventbrite(count, venues):
+    """ `count` events of an Eventbrite organizer, held at `venues` venues """
+    first = windowStart()
+    events = []
+    for n in range(count):
+        start = first + timedelta(days=n * 240 / max(count, 1))
+        events.append({
+            "name": {"text": "Event %d" % n},
+            "description": {"text": "Description of event %d" % n},
+            "start": {"local": start.strftime("%Y-%m-%dT%H:%M:%S")},
+            "end": {"local": (start + timedelta(hours=2)).strftime("%Y-%m-%dT%H:%M:%S")},
+            "url": "https://www.eventbrite.com/e/%d" % n,
+            "id": str(n),
+            "venue_id": str(n % venues),
+        })
+    return events
+
+# -------------------------------------------------------------
+#  Import cron.py into a scratch directory
+# -------------------------------------------------------------
+
+def loadCron(server, config):
+    """
+    Imports a copy of cron.py that lives in a temporary directory together with
+    the given config, so data and cache files never touch the real ones.
+    Eventbrite clients send their requests to the local server.
+    """
+    workdir = tempfile.mkdtemp(prefix="community_calendar-")
+    for filename in glob.glob(directory + "/*.py"):
+        shutil.copy(filename, workdir)
+    os.mkdir(workdir + "/data")
+    with open(workdir + "/config.yaml", "w") as f:
+        yaml.safe_dump(config, f)
+
+    spec = importlib.util.spec_from_file_location("cron", workdir + "/cron.py")
+    cron = importlib.util.module_from_spec(spec)
+    # importable under its name, for the worker processes of the parse pool
+    sys.modules["cron"] = cron
+    sys.path.insert(0, workdir)
+    spec.loader.exec_module(cron)
+    eventbrite.Eventbrite = partial(eventbrite.Eventbrite, eventbrite_api_url=server.url("/eventbrite/"))
+    cron.workdir = workdir
+    return cron
+
+def clearCache(cron):
+    shutil.rmtree(cron.cache_directory, ignore_errors=True)
+    cron.venue_cache = None
+
+# -------------------------------------------------------------
+#  Measuring
+# -------------------------------------------------------------
+
+def measure(name, function, *args, count=len):
+    """
+    Runs function twice, once for the time and once under tracemalloc for the
+    peak memory, and prints a line of results. count() gets the result and
+    returns the number of events it covers.
+    """
+    start = time.perf_counter()
+    result = function(*args)
+    seconds = time.perf_counter() - start
+
+    tracemalloc.start()
+    function(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    events = count(result)
+    print("%-36s %8d %10.3f %10.0f %10.1f" % (name, events, seconds, events / seconds, peak / 2**20))
+    return result
+
+def header(title):
+    print()
+    print("%-36s %8s %10s %10s %10s" % (title, "events", "seconds", "events/s", "peak MiB"))
+
+# -------------------------------------------------------------
+#  Benchmarks
+# -------------------------------------------------------------
+
+def benchmarkIcal(server, cron, scale):
+    """ parseIcal and parseIcalOld on feeds of varying size and recurrence density """
+    header("ICS feeds")
+    cron.fetch_cache = False
+
+    feeds = [
+        ("%d one-off events" % (500 * scale), 500 * scale, 0, 0),
+        ("%d one-off events" % (2000 * scale), 2000 * scale, 0, 0),
+        ("%d daily series" % (5 * scale), 0, 5 * scale, 0),
+        ("%d daily series" % (20 * scale), 0, 20 * scale, 0),
+        ("%d one-off, %d series" % (500 * scale, 10 * scale), 500 * scale, 10 * scale, 0),
+    ]
+    for label, single, series, overrides in feeds:
+        path = "/ical-%d-%d-%d.ics" % (single, series, overrides)
+        server.feeds[path] = syntheticIcal(single, series, overrides)
+        measure("parseIcal, " + label, cron.parseIcal, server.url(path))
+        measure("parseIcalOld, " + label, cron.parseIcalOld, server.url(path))
+
+    cron.fetch_cache = True
+    return True
+
+def benchmarkOverrides(server, cron, scale, overrides=60):
+    """
+    parseIcalOld on feeds with a growing number of heavily overridden series.
+    Checks that every override replaced its occurrence.
+    """
+    header("parseIcalOld, %d overrides per series" % overrides)
+    cron.fetch_cache = False
+    ok = True
+
+    for series in [5 * scale, 10 * scale, 20 * scale, 40 * scale]:
+        path = "/overrides-%d.ics" % series
+        server.feeds[path] = syntheticIcal(0, series, overrides)
+        events = measure("%d series" % series, cron.parseIcalOld, server.url(path))
+
+        moved = len([e for e in events if e.title.endswith("(moved)")])
+        days = set((e.title.replace(" (moved)", ""), e.start.date()) for e in events)
+        if moved != series * overrides or len(days) != len(events):
+            print("  %d of %d overrides applied, %d duplicate days"
+                  % (moved, series * overrides, len(events) - len(days)))
+            ok = False
+
+    cron.fetch_cache = True
+    return ok
+
+def benchmarkWindow(server, cron, scale, days=(1, 7, 30)):
+    """
+    parseIcal on the next days, expanding just the days the window moved on.
+    Checks that the occurrences are the same as when expanding all of it, also
+    of events at the bounds of the window and of a moved occurrence.
+    """
+    header("parseIcal, window moved on")
+    ok = True
+
+    today = datetime.now(cron.tz).date()
+    feeds = [("/window.ics", "", syntheticIcal(500 * scale, 10 * scale, 0, syntheticBoundaries(today, days))),
+             ("/window-moved.ics", ", moved", syntheticIcal(500 * scale, 10 * scale, 0, syntheticMovedOccurrence(today)))]
+    def occurrences(events):
+        return sorted((e.uid or "", e.start, e.end, e.title) for e in events)
+
+    for (path, label, data), shift in [(feed, shift) for feed in feeds for shift in days]:
+        server.feeds[path] = data
+        clearCache(cron)
+        cron.replay_time = None
+        cron.parseIcal(server.url(path))
+        cron.replay_time = time.time() + shift * 86400
+
+        # measure() runs it twice, both times from the cache entry of the first day
+        def incremental():
+            cached = cron.cachePath(server.url(path), ".events.json")
+            shutil.copy(cached, cached + ".first")
+            try:
+                return cron.parseIcal(server.url(path))
+            finally:
+                os.replace(cached + ".first", cached)
+        events = measure("%d days later%s, incremental" % (shift, label), incremental)
+        cron.fetch_cache = False
+        expected = measure("%d days later%s, in full" % (shift, label), cron.parseIcal, server.url(path))
+        cron.fetch_cache = True
+
+        if occurrences(events) != occurrences(expected):
+            print("  %d occurrences missing, %d extra"
+                  % (len(set(occurrences(expected)) - set(occurrences(events))),
+                     len(set(occurrences(events)) - set(occurrences(expected)))))
+            ok = False
+
+    cron.replay_time = None
+    return ok
+
+def benchmarkMicrodata(server, cron, scale):
+    header("Microdata pages")
+    cron.fetch_cache = False
+
+    for count in [100 * scale, 500 * scale]:
+        path = "/microdata-%d.html" % count
+        server.feeds[path] = syntheticMicrodata(count)
+        measure("parseMicrodata, %d events" % count, cron.parseMicrodata, server.url(path))
+
+    cron.fetch_cache = True
+    return True
+
+def benchmarkEventbrite(server, cron, scale):
+    """ parseEventbrite with cold and warm venue caches """
+    header("Eventbrite organizers")
+
+    for count in [100 * scale, 500 * scale]:
+        organizer = "organizer-%d" % count
+        server.organizers[organizer] = syntheticEventbrite(count, 20)
+
+        clearCache(cron)
+        cron.fetch_cache = False
+        measure("parseEventbrite, %d events, cold" % count, cron.parseEventbrite, organizer)
+        cron.fetch_cache = True
+        cron.parseEventbrite(organizer)
+        measure("parseEventbrite, %d events, warm" % count, cron.parseEventbrite, organizer)
+
+    return True
+
+def benchmarkGeneration(server, cron, scale):
+    """ ICS generation from the events of a large feed, in memory and streamed to disk """
+    header("Output generation")
+    cron.fetch_cache = False
+
+    path = "/generation.ics"
+    server.feeds[path] = syntheticIcal(2000 * scale, 10 * scale, 0)
+    events = cron.parseIcal(server.url(path))
+    measure("icalFromEvents", cron.icalFromEvents, events, count=lambda result: len(events))
+    measure("writeIcal", cron.writeIcal, [("generation", {}, events)], count=lambda result: len(events))
+
+    cron.fetch_cache = True
+    return True
+
+def benchmarkPool(server, cron, scale, feeds=4):
+    """ Several large ICS sources fetched concurrently, parsed in threads and in worker processes """
+    header("%d ICS sources at once" % feeds)
+    cron.fetch_cache = False
+
+    sources = {}
+    for n in range(feeds):
+        path = "/pool-%d.ics" % n
+        server.feeds[path] = syntheticIcal(2000 * scale, 10 * scale, 0)
+        sources["ics%d" % n] = {"type": "ics", "url": server.url(path)}
+
+    def events(result):
+        return sum(len(events) for events in result[0].values())
+
+    cron.ics_parse_workers = 0
+    measure("fetchSources, in threads", cron.fetchSources, sources, count=events)
+    cron.ics_parse_workers = feeds
+    cron.ics_parse_min_size = 0
+    # once to start the workers
+    cron.fetchSources(sources)
+    measure("fetchSources, %d processes" % feeds, cron.fetchSources, sources, count=events)
+
+    cron.ics_parse_workers = 0
+    cron.fetch_cache = True
+    return True
+
+def benchmarkCron(server, cron, scale):
+    """ The whole cron job on a mix of sources, with a cold and a warm cache """
+    header("Full cron run")
+
+    sources = {}
+    for n in range(4):
+        path = "/cron-%d.ics" % n
+        server.feeds[path] = syntheticIcal(200 * scale, 2 * scale, 10)
+        sources["ics%d" % n] = {"title": "ICS %d" % n, "color": "red", "type": "ics", "url": server.url(path)}
+    server.feeds["/cron.html"] = syntheticMicrodata(200 * scale)
+    sources["microdata"] = {"title": "Microdata", "color": "blue", "type": "microdata", "url": server.url("/cron.html")}
+    server.organizers["cron"] = syntheticEventbrite(200 * scale, 20)
+    sources["eventbrite"] = {"title": "Eventbrite", "color": "green", "type": "eventbrite", "organizer": "cron"}
+    sources["multiple"] = {"title": "Multiple", "color": "grey", "type": "multiple", "sources": [
+        {"type": "ics", "url": server.url("/cron-0.ics")},
+        {"type": "microdata", "url": server.url("/cron.html")},
+    ]}
+
+    def events(result):
+        with open(cron.workdir + "/data/all.ics", "rb") as f:
+            return f.read().count(b"BEGIN:VEVENT")
+
+    def cold():
+        clearCache(cron)
+        cron.run(sources)
+
+    measure("cron.run(), cold cache", cold, count=events)
+    measure("cron.run(), warm cache", cron.run, sources, count=events)
+    return True
+
+benchmarks = {
+    "ical": benchmarkIcal,
+    "overrides": benchmarkOverrides,
+    "window": benchmarkWindow,
+    "microdata": benchmarkMicrodata,
+    "eventbrite": benchmarkEventbrite,
+    "generation": benchmarkGeneration,
+    "pool": benchmarkPool,
+    "cron": benchmarkCron,
+}
+
+def main():
+    parser = ArgumentParser(description="Benchmark the cron job against synthetic feeds served locally")
+    parser.add_argument("--scale", type=int, default=1,
+                        help="multiply the size of all synthetic feeds")
+    parser.add_argument("--only", nargs="+", choices=list(benchmarks),
+                        help="benchmarks to run, all by default")
+    args = parser.parse_args()
+
+    server = FeedServer()
+    cron = loadCron(server, {
+        "ICAL_CALNAME": "Benchmark",
+        "EVENTBRITE_OAUTH_TOKEN": "benchmark",
+        "TZ": "Europe/Berlin",
+        "SOURCES": {},
+    })
+
+    ok = True
+    try:
+        for name in args.only or benchmarks:
+            ok = benchmarks[name](server, cron, args.scale) and ok
+    finally:
+        shutil.rmtree(cron.workdir)
+        server.shutdown()
+
+    sys.exit(0 if ok else 1)
+
+if __name__ == "__main__":
+    main()
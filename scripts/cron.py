@@ -5,38 +5,52 @@
 #  Cron job to generate json files for event sources
 # -------------------------------------------------------------
 
-from icalevents.icalevents import events as iCalEvents
-
-from icalendar import Calendar, Event
 import urllib.request, urllib.error, urllib.parse
-from dateutil import rrule
 from datetime import datetime, timedelta, date
-from pytz import timezone
+from pytz import timezone, utc
 import json
-from eventbrite import Eventbrite
 import os
 from math import floor
-from dateutil.parser import parse
 import sys
-
-# Microdata
-import microdata
+import time
+import threading
+import hashlib
+import tempfile
+import gzip
+import importlib
+import codecs
+import itertools
+from html.parser import HTMLParser
+from html import unescape
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+import queue
 from urllib.parse import urljoin
-
-# FB Fallback
 import re
-from bs4 import BeautifulSoup
-import requests
-import dateparser
+import unicodedata
 
 #import config
 import yaml
-from argparse import Namespace
+from argparse import Namespace, ArgumentParser
 import logging
-from functools import reduce
 
 import traceback
 
+from events import Event, dt_format
+
+# The libraries for parsing the different source types (icalevents,
+# icalendar, eventbrite, bs4, requests, dateparser, dateutil) are only
+# imported by the functions using them, so a run only loads what the
+# configured sources need.
+
+# Optional, .br files are only written if it's installed
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
 def loadConfig():
     with open(os.path.dirname(os.path.realpath(__file__)) + '/config.yaml', 'r') as ymlfile:
         cfg = yaml.safe_load(ymlfile)
@@ -44,15 +58,550 @@ def loadConfig():
     ns = Namespace(**cfg)
     return ns
 
-logging.basicConfig(format = '%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.WARN)
 logger = logging.getLogger(__name__)
 
 config = loadConfig()
 
-dt_format = "%Y-%m-%dT%H:%M:%S%z"
+directory = os.path.dirname(os.path.realpath(__file__))
+
 tz = timezone(config.TZ)
 
+# Number of sources fetched in parallel, and the time in seconds after which
+# a single source is given up on
+fetch_concurrency = getattr(config, "FETCH_CONCURRENCY", 8)
+fetch_timeout = getattr(config, "FETCH_TIMEOUT", 120)
+
+# The agenda view gets the next UPCOMING_EVENTS events within UPCOMING_DAYS
+upcoming_events = getattr(config, "UPCOMING_EVENTS", 15)
+upcoming_days = getattr(config, "UPCOMING_DAYS", 180)
+
+# tweet.py and toot.py post the events DAYS_AHEAD days from now, cron.py
+# indexes the days until then by date in data/_days.json
+days_ahead = getattr(config, "DAYS_AHEAD", 1)
+
+# Additionally split every source into one file per month, for the calendar
+# view to load only the months on screen
+output_shards = getattr(config, "OUTPUT_SHARDS", False)
+
+# Most outputs are written again on every run, the highest brotli quality
+# takes far longer for hardly smaller files
+brotli_quality = 5
+
+# Minutes between refreshes of a source in daemon mode, unless the source
+# sets its own "interval"
+refresh_interval = getattr(config, "REFRESH_INTERVAL", 60)
+
+# A source failing again is only retried after RETRY_BACKOFF minutes, doubling
+# with every further failure up to RETRY_BACKOFF_MAX minutes
+retry_backoff = getattr(config, "RETRY_BACKOFF", 60)
+retry_backoff_max = getattr(config, "RETRY_BACKOFF_MAX", 24 * 60)
+
+# Raw feeds, their HTTP validators and the events parsed from them are kept
+# here between runs
+fetch_cache = getattr(config, "FETCH_CACHE", True)
+cache_directory = directory + "/cache"
+
+# The generated files served to everyone. A replayed run writes them
+# somewhere else, so it never replaces those of the live calendar.
+data_directory = directory + "/data"
+
+# Per-source timings and health of the last run go to METRICS_FILE and to a
+# file for the textfile collector of the Prometheus node exporter, both next
+# to the cache by default rather than with the public files in data/
+metrics_file = getattr(config, "METRICS_FILE", cache_directory + "/_metrics.json")
+metrics_textfile = getattr(config, "METRICS_TEXTFILE", cache_directory + "/_metrics.prom")
+
+# Events of different sources with the same title and location, starting
+# within DEDUP_MINUTES of each other, are merged into the one of the source
+# ranked first in DEDUP_PRECEDENCE, by name or type, or else configured first
+dedup = getattr(config, "DEDUP", True)
+dedup_minutes = getattr(config, "DEDUP_MINUTES", 30)
+dedup_precedence = getattr(config, "DEDUP_PRECEDENCE", None) or []
+
+# data/changes.json lists the events added, changed and removed in the last
+# CHANGES_HOURS hours
+changes_hours = getattr(config, "CHANGES_HOURS", 24)
+
+# Events are kept from this many days ago on. Those ending before aren't
+# listed as removed in data/changes.json when they drop out.
+past_days = 60
+
+
+
+# -------------------------------------------------------------
+#  Write files
+# -------------------------------------------------------------
+def writeAtomic(filename, data):
+    """
+    Writes data to a temporary file next to filename and renames it into
+    place, so readers never see a partially written file.
+    """
+    fd, tmp_filename = tempfile.mkstemp(dir=os.path.dirname(filename), prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.chmod(tmp_filename, 0o644)
+        os.replace(tmp_filename, filename)
+    except BaseException:
+        os.remove(tmp_filename)
+        raise
+
+def fileDigest(filename):
+    try:
+        digest = hashlib.sha256()
+        with open(filename, "rb") as f:
+            for chunk in iter(lambda: f.read(65536), b""):
+                digest.update(chunk)
+        return digest.hexdigest()
+    except OSError:
+        return None
+
+def writeOutput(filename, data):
+    """
+    Writes a generated file, with .gz and .br siblings for nginx to serve as
+    is. If the content didn't change, nothing is written and the file keeps
+    its mtime, so Last-Modified and ETag stay the same for HTTP clients.
+    Returns whether the file changed.
+    """
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+
+    changed = fileDigest(filename) != hashlib.sha256(data).hexdigest()
+
+    # compressed copies first, so a file that is up to date has them too
+    if changed or not os.path.exists(filename + ".gz"):
+        writeAtomic(filename + ".gz", gzip.compress(data, compresslevel=9, mtime=0))
+
+    if brotli and (changed or not os.path.exists(filename + ".br")):
+        writeAtomic(filename + ".br", brotli.compress(data, quality=brotli_quality))
+    elif not brotli and os.path.exists(filename + ".br"):
+        # nginx would go on serving it, whatever the file changes to
+        os.remove(filename + ".br")
+
+    if changed:
+        writeAtomic(filename, data)
+
+    return changed
+
+class OutputStream:
+    """
+    Writes a generated file chunk by chunk, so its content is never held in
+    memory at once. close() moves it into place like writeOutput does, with
+    compressed siblings, only if the content changed, and returns whether
+    it did.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.digest = hashlib.sha256()
+        fd, self.tmp_filename = tempfile.mkstemp(dir=os.path.dirname(filename), prefix=".tmp-")
+        self.f = os.fdopen(fd, "wb")
+
+    def write(self, chunk):
+        self.digest.update(chunk)
+        self.f.write(chunk)
+
+    def close(self):
+        try:
+            self.f.close()
+            changed = fileDigest(self.filename) != self.digest.hexdigest()
+
+            # compressed copies first, so a file that is up to date has them too
+            if changed or not os.path.exists(self.filename + ".gz"):
+                self.compress(self.filename + ".gz", lambda f: gzip.GzipFile("", "wb", 9, f, mtime=0))
+            if brotli and (changed or not os.path.exists(self.filename + ".br")):
+                self.compress(self.filename + ".br", BrotliFile)
+            elif not brotli and os.path.exists(self.filename + ".br"):
+                os.remove(self.filename + ".br")
+
+            if changed:
+                os.chmod(self.tmp_filename, 0o644)
+                os.replace(self.tmp_filename, self.filename)
+        finally:
+            self.abort()
+
+        return changed
+
+    def compress(self, filename, compressor):
+        """ Compresses the written content into filename, chunk by chunk """
+        fd, tmp_filename = tempfile.mkstemp(dir=os.path.dirname(filename), prefix=".tmp-")
+        try:
+            with open(self.tmp_filename, "rb") as source, os.fdopen(fd, "wb") as f:
+                with compressor(f) as target:
+                    for chunk in iter(lambda: source.read(65536), b""):
+                        target.write(chunk)
+            os.chmod(tmp_filename, 0o644)
+            os.replace(tmp_filename, filename)
+        except BaseException:
+            os.remove(tmp_filename)
+            raise
+
+    def abort(self):
+        """ Discards what has been written and not moved into place """
+        self.f.close()
+        if os.path.exists(self.tmp_filename):
+            os.remove(self.tmp_filename)
+
+class BrotliFile:
+    """ Minimal file-like wrapper compressing with brotli into f """
+    def __init__(self, f):
+        self.f = f
+        self.compressor = brotli.Compressor(quality=brotli_quality)
+
+    def write(self, chunk):
+        self.f.write(self.compressor.process(chunk))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        if exc[0] is None:
+            self.f.write(self.compressor.finish())
+
+def removeOutput(filename):
+    """ Removes a generated file along with its compressed siblings """
+    for name in (filename, filename + ".gz", filename + ".br"):
+        if os.path.exists(name):
+            os.remove(name)
+
+# -------------------------------------------------------------
+#  Record and replay the responses of a run
+# -------------------------------------------------------------
+
+# With --record DIR every response of the sources is kept in DIR, with
+# --replay DIR a run is made from them alone, without any network access
+archive_mode = None
+archive_directory = None
+
+# A replayed run pretends to run at the time of the recording
+replay_time = None
+
+class ArchiveMissing(Exception):
+    """ A request of a replayed run that wasn't made in the recorded one """
+
+class ReplayedError(Exception):
+    """ Stands in for the error a request failed with in the recorded run """
+
+def clock():
+    """ Seconds since the epoch, the time of the recording when replaying one """
+    return replay_time if replay_time is not None else time.time()
+
+def inSource(function):
+    """
+    Wraps function to run in the fetch job of the calling thread, for pools
+    of worker threads within one source
+    """
+    source = getattr(current, "source", None)
+    def wrapped(*args):
+        current.source = source
+        return function(*args)
+    return wrapped
+
+def archivePath(key, suffix):
+    source = getattr(current, "source", None) or "_"
+    return "%s/%s/%s%s" % (archive_directory, source, hashlib.sha1(key.encode("utf-8")).hexdigest(), suffix)
+
+def archived(key, fetch):
+    """
+    Returns fetch(), the body of the response to the request identified by
+    key, as bytes. When recording it is also written to the archive, below
+    the name of the source, and when replaying it is read from there instead.
+    Failed requests are recorded and fail again on replay.
+    """
+    if archive_mode is None:
+        return fetch()
+
+    if archive_mode == "replay":
+        try:
+            with open(archivePath(key, ".json")) as meta_file:
+                meta = json.load(meta_file)
+        except OSError:
+            raise ArchiveMissing("%s was not recorded" % key)
+        if "error" in meta:
+            raise ReplayedError(meta["error"])
+        with open(archivePath(key, ".body"), "rb") as body_file:
+            return body_file.read()
+
+    os.makedirs(os.path.dirname(archivePath(key, "")), exist_ok=True)
+    try:
+        data = fetch()
+    except Exception as e:
+        writeAtomic(archivePath(key, ".json"), json.dumps({"key": key, "error": "%s: %s" % (type(e).__name__, e)}).encode("utf-8"))
+        raise
+    writeAtomic(archivePath(key, ".body"), data)
+    writeAtomic(archivePath(key, ".json"), json.dumps({"key": key, "size": len(data)}).encode("utf-8"))
+    return data
+
+def startRecording(path, sources):
+    """ Starts an archive in path with the sources of the run and its time """
+    global archive_mode, archive_directory, fetch_cache
+    archive_mode, archive_directory = "record", path
+    # everything is fetched, nothing is reused from the cache
+    fetch_cache = False
+    os.makedirs(path, exist_ok=True)
+    manifest = {"recorded": time.time(), "tz": config.TZ, "sources": sources}
+    writeAtomic(path + "/manifest.json", json.dumps(manifest, indent=2).encode("utf-8"))
+
+def startReplay(path, output=None):
+    """
+    Switches to replaying the archive in path, returns its sources. The
+    generated files and the metrics go to output, by default the directory
+    output in the archive.
+    """
+    global archive_mode, archive_directory, fetch_cache, replay_time
+    global data_directory, metrics_file, metrics_textfile
+    with open(path + "/manifest.json") as manifest_file:
+        manifest = json.load(manifest_file)
+    archive_mode, archive_directory = "replay", path
+    fetch_cache = False
+    replay_time = manifest["recorded"]
+
+    data_directory = output or path + "/output"
+    metrics_file = data_directory + "/_metrics.json"
+    metrics_textfile = data_directory + "/_metrics.prom"
+    os.makedirs(data_directory, exist_ok=True)
+    return manifest["sources"]
+
+# -------------------------------------------------------------
+#  Conditional fetching with an on-disk cache
+# -------------------------------------------------------------
+def cachePath(url, suffix):
+    return "%s/%s%s" % (cache_directory, hashlib.sha1(url.encode("utf-8")).hexdigest(), suffix)
+
+def writeCacheFile(filename, data):
+    os.makedirs(cache_directory, exist_ok=True)
+    writeAtomic(filename, data)
+
+def readCacheFile(filename):
+    try:
+        with open(filename, "rb") as f:
+            return f.read()
+    except OSError:
+        return None
+
+def fetchUrl(url, headers={}, validate=True):
+    """
+    GET url, sending along the validators of the copy fetched on the last run
+    if that copy is still in the cache. Returns the body and its SHA-256 hash.
+    On a 304 the cached body is returned.
+    """
+    if archive_mode is not None:
+        start = time.monotonic()
+        data = archived(url, lambda: urllib.request.urlopen(
+                urllib.request.Request(url, headers=headers), timeout=fetch_timeout).read())
+        recordFetch(time.monotonic() - start, len(data))
+        return data, hashlib.sha256(data).hexdigest()
+
+    meta = {}
+    if fetch_cache and validate and os.path.exists(cachePath(url, ".body")):
+        try:
+            meta = json.loads(readCacheFile(cachePath(url, ".json")))
+        except (TypeError, ValueError):
+            pass
+
+    request_headers = dict(headers)
+    if "etag" in meta:
+        request_headers["If-None-Match"] = meta["etag"]
+    if "last_modified" in meta:
+        request_headers["If-Modified-Since"] = meta["last_modified"]
+
+    req = urllib.request.Request(url, headers=request_headers)
+    start = time.monotonic()
+    try:
+        response = urllib.request.urlopen(req, timeout=fetch_timeout)
+    except urllib.error.HTTPError as err:
+        if err.code == 304:
+            data = readCacheFile(cachePath(url, ".body"))
+            if data is not None:
+                logger.debug("%s not modified" % url)
+                recordFetch(time.monotonic() - start, cache_hit=True)
+                return data, meta["sha256"]
+            if validate:
+                # the copy went missing since, fetch it without validators
+                recordFetch(time.monotonic() - start)
+                return fetchUrl(url, headers, validate=False)
+        recordFetch(time.monotonic() - start)
+        logger.error("Error while fetching %s: %s" % (url, err.reason))
+        raise
+    except urllib.error.URLError as err:
+        recordFetch(time.monotonic() - start)
+        logger.error("Error while fetching %s: %s" % (url, err.reason))
+        raise
+
+    data = response.read()
+    digest = hashlib.sha256(data).hexdigest()
+    recordFetch(time.monotonic() - start, len(data), cache_hit=digest == meta.get("sha256"))
+
+    if fetch_cache:
+        new_meta = {"url": url, "sha256": digest}
+        if response.headers.get("ETag"):
+            new_meta["etag"] = response.headers["ETag"]
+        if response.headers.get("Last-Modified"):
+            new_meta["last_modified"] = response.headers["Last-Modified"]
+
+        if digest != meta.get("sha256"):
+            writeCacheFile(cachePath(url, ".body"), data)
+        if new_meta != meta:
+            writeCacheFile(cachePath(url, ".json"), json.dumps(new_meta).encode("utf-8"))
+
+    return data, digest
+
+def fetchAndParse(url, key, parse, headers={}, update=None):
+    """
+    Fetch url and pass the body to parse(). If the body is the same as on the
+    last run and was parsed with the same key back then, the events parsed on
+    that run are returned instead. The key has to change whenever parse()
+    would give a different result for the same body, e.g. with the date.
+
+    If the body is the same but the key isn't, update(data, cached) gets a
+    chance to derive the events from the cache entry of the last run. It
+    returns None to have the body parsed from scratch.
+    """
+    data, digest = fetchUrl(url, headers)
+
+    events = None
+    events_filename = cachePath(url, ".events.json")
+    if fetch_cache:
+        try:
+            cached = json.loads(readCacheFile(events_filename))
+            if cached["sha256"] == digest and cached["key"] == key:
+                logger.debug("Reusing parsed events for %s" % url)
+                recordCacheHit()
+                return [Event.fromDict(event, tz) for event in cached["events"]]
+            if cached["sha256"] == digest and update:
+                cached["events"] = [Event.fromDict(event, tz) for event in cached["events"]]
+                events = update(data, cached)
+        except (TypeError, ValueError, KeyError):
+            pass
+
+    if events is None:
+        events = parse(data)
+
+    if fetch_cache:
+        cached = {"sha256": digest, "key": key, "events": [event.toDict() for event in events]}
+        writeCacheFile(events_filename, json.dumps(cached).encode("utf-8"))
+
+    return events
+
+# -------------------------------------------------------------
+#  Per-source metrics
+# -------------------------------------------------------------
 
+# The metrics and source name of the fetch job running in the current thread
+current = threading.local()
+
+def newMetrics():
+    return {
+        "seconds": 0.0,
+        "fetch_seconds": 0.0,
+        "parse_seconds": 0.0,
+        "requests": 0,
+        "bytes": 0,
+        "cache_hits": 0,
+        "events": 0,
+        "errors": 0,
+        "skipped": 0,
+    }
+
+def recordFetch(seconds, size=0, cache_hit=False):
+    """ Adds a request to the metrics of the fetch job running in this thread """
+    metrics = getattr(current, "metrics", None)
+    if metrics is None:
+        return
+    metrics["fetch_seconds"] += seconds
+    metrics["requests"] += 1
+    metrics["bytes"] += size
+    if cache_hit:
+        recordCacheHit()
+
+def recordCacheHit():
+    metrics = getattr(current, "metrics", None)
+    if metrics is not None:
+        metrics["cache_hits"] += 1
+
+def prometheusMetrics(metrics, run):
+    """ Formats the metrics of a run in the Prometheus text exposition format """
+    def label(value):
+        return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+    descriptions = [
+        ("seconds", "Time it took to fetch and parse the source"),
+        ("fetch_seconds", "Time spent waiting for the servers of the source"),
+        ("parse_seconds", "Time spent parsing the source"),
+        ("requests", "HTTP requests made for the source"),
+        ("bytes", "Bytes downloaded for the source"),
+        ("cache_hits", "Feeds, parsed events and venues reused from the cache"),
+        ("events", "Events of the source"),
+        ("errors", "Failed fetches of the source"),
+        ("stale", "Whether the events of the last successful run were used"),
+        ("skipped", "Whether the source wasn't fetched while backing off after failures"),
+    ]
+
+    lines = []
+    for key, description in descriptions:
+        name = "community_calendar_source_%s" % key
+        lines.append("# HELP %s %s" % (name, description))
+        lines.append("# TYPE %s gauge" % name)
+        for source_name, source_metrics in metrics.items():
+            lines.append('%s{source="%s"} %s' % (name, label(source_name), float(source_metrics[key])))
+
+    lines.append("# HELP community_calendar_run_seconds Time the whole run took")
+    lines.append("# TYPE community_calendar_run_seconds gauge")
+    lines.append("community_calendar_run_seconds %s" % run["seconds"])
+    lines.append("# HELP community_calendar_run_timestamp_seconds Time the last run finished")
+    lines.append("# TYPE community_calendar_run_timestamp_seconds gauge")
+    lines.append("community_calendar_run_timestamp_seconds %s" % run["finished"])
+    return "\n".join(lines) + "\n"
+
+def occurrenceUid(uid, when):
+    """
+    Tells the occurrences of a recurring event apart by their original
+    start, which an occurrence keeps when it is moved
+    """
+    if isinstance(when, datetime):
+        if when.tzinfo:
+            when = when.astimezone(utc)
+        return "%s/%s" % (uid, when.strftime("%Y%m%dT%H%M%SZ"))
+    return "%s/%s" % (uid, when.strftime("%Y%m%d"))
+
+# -------------------------------------------------------------
+#  Parse large feeds in worker processes
+# -------------------------------------------------------------
+
+# Parsing and expanding recurrences is CPU bound and holds the GIL, so feeds
+# of at least ICS_PARSE_MIN_KB are parsed in a pool of ICS_PARSE_WORKERS
+# processes, if set. Only the parsed events are sent back.
+ics_parse_workers = getattr(config, "ICS_PARSE_WORKERS", 0)
+ics_parse_min_size = getattr(config, "ICS_PARSE_MIN_KB", 512) * 1024
+
+parse_pool = None
+parse_pool_lock = threading.Lock()
+
+def parseInPool(function, data, *args):
+    """
+    Returns function(data, *args), called in the parse pool if data is large
+    enough and the pool is enabled. function has to be defined at module
+    level and return Events, so both can be pickled.
+    """
+    global parse_pool
+    if ics_parse_workers <= 0 or len(data) < ics_parse_min_size:
+        return function(data, *args)
+
+    with parse_pool_lock:
+        if parse_pool is None:
+            # not forked, other threads may hold locks at that moment
+            method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+            parse_pool = ProcessPoolExecutor(max_workers=ics_parse_workers,
+                                             mp_context=multiprocessing.get_context(method))
+        pool = parse_pool
+
+    try:
+        return pool.submit(function, data, *args).result()
+    except BrokenProcessPool:
+        # a worker died, e.g. out of memory. Start a new pool next time.
+        with parse_pool_lock:
+            if parse_pool is pool:
+                parse_pool = None
+        raise
 
 # -------------------------------------------------------------
 #  iCal parsing support functions
@@ -81,32 +630,89 @@ def icalToDict(event, output):
 # -------------------------------------------------------------
 #  Parse iCal from URL
 # -------------------------------------------------------------
+def icalEventUid(event):
+    if event.uid == "-1":
+        return None
+    if event.recurrence_id:
+        return occurrenceUid(event.uid, event.recurrence_id)
+    if event.recurring:
+        return occurrenceUid(event.uid, event.start)
+    return event.uid
+
+def expandIcal(data, start, end):
+    """ The occurrences of the events in the feed between start and end """
+    from icalevents.icalevents import events as iCalEvents
+
+    events = iCalEvents(string_content=data, start=start, end=end)
+
+    return [ Event(event.summary, event.start, event.end, tz, all_day=event.all_day,
+        description=event.description,
+        location=event.location,
+        url=event.url,
+        uid=icalEventUid(event)
+    ) for event in events ]
+
+def expandIcalWindows(data, windows):
+    """ expandIcal() for each of the (start, end) windows, in one go for the parse pool """
+    return [expandIcal(data, start, end) for start, end in windows]
+
+def withoutEvents(events, removed):
+    """
+    events without those equal to one in removed, each taken out as often as
+    it is in there
+    """
+    counts = Counter(tuple(getattr(event, key) for key in Event.__slots__) for event in removed)
+    kept = []
+    for event in events:
+        key = tuple(getattr(event, key) for key in Event.__slots__)
+        if counts[key]:
+            counts[key] -= 1
+        else:
+            kept.append(event)
+    return kept
+
 def parseIcal(url):
-    today = datetime.now(tz).replace(hour=0,minute=0)
-    time_min = today + timedelta(days = -60)
+    today = datetime.fromtimestamp(clock(), tz).replace(hour=0, minute=0, second=0, microsecond=0)
+    time_min = today + timedelta(days = -past_days)
     time_max = today + timedelta(days = 1*180)
-    events = iCalEvents(url, start=time_min, end=time_max)
-
-    event_list = [ {
-        "title": event.summary,
-        "description": event.description,
-        "location": event.location,
-        "url": event.url,
-        "start": event.start.strftime(dt_format),
-        "end": event.end.strftime(dt_format)
-    } for event in events ]
 
-    return event_list
+    def update(data, cached):
+        # Same feed as on the last run, only the window moved on. Keep the
+        # occurrences that are still in it and expand just the days it moved.
+        if cached["key"][0] != key[0]:
+            return None
+        old_min, old_max = [datetime.fromisoformat(x) for x in cached["key"][1:]]
+        if not old_min <= time_min <= old_max <= time_max:
+            return None
+        # an override can move an occurrence out of the days expanded last
+        # time, which would then keep the occurrence and add the override
+        if b"RECURRENCE-ID" in data:
+            return None
+
+        # icalevents keeps one-off events that overlap the window, bounds
+        # included, but occurrences of a series only if they start in it.
+        # Rather than repeating its rules: what a window split in two has in
+        # both halves is just what the window of the point between them has.
+        logger.debug("Expanding %s from %s on" % (url, old_max.date()))
+        dropped, at_min, added, at_max = parseInPool(expandIcalWindows, data,
+                [(old_min, time_min), (time_min, time_min), (old_max, time_max), (old_max, old_max)])
+        return (withoutEvents(cached["events"], withoutEvents(dropped, at_min))
+                + withoutEvents(added, at_max))
+
+    key = ["ics-v4", time_min.isoformat(), time_max.isoformat()]
+    return fetchAndParse(url, key, lambda data: parseInPool(expandIcal, data, time_min, time_max), update=update)
 
 def parseIcalOld(url):
-    req = urllib.request.Request(url, headers={ 'User-Agent': 'Mozilla/5.0' }) #required for Meetup :(
-    try:
-        response = urllib.request.urlopen(req)
-    except urllib.error.URLError as err:
-        logger.error("Error while fetching %s: %s" % (url, err.msg))
-        raise
+    today = datetime.fromtimestamp(clock(), tz).replace(hour=0,minute=0)
+    time_min = today + timedelta(days = -past_days)
+    time_max = today + timedelta(days = 1*180)
+    return fetchAndParse(url, "ics-old-v3:%s" % today.date(),
+            lambda data: parseInPool(icalToEvents, data, url, time_min, time_max),
+            headers={ 'User-Agent': 'Mozilla/5.0' }) #required for Meetup :(
 
-    data = response.read()
+def icalToEvents(data, url, time_min, time_max):
+    from icalendar import Calendar
+    from dateutil import rrule
 
     try:
         cal = Calendar.from_ical(data)
@@ -114,10 +720,6 @@ def parseIcalOld(url):
         logger.error("Error parsing feed " + url)
         raise
 
-    today = datetime.now(tz).replace(hour=0,minute=0)
-    time_min = today + timedelta(days = -60)
-    time_max = today + timedelta(days = 1*180)
-
     event_list = []
 
     for event in cal.walk('vevent'):
@@ -134,15 +736,14 @@ def parseIcalOld(url):
 
             duration = event.get('dtend').dt - event.get('dtstart').dt
 
-            for revent in rule.between(time_min, time_max):
-                event_data = {
-                    "start": revent.strftime(dt_format),
-                    "end": (revent + duration).strftime(dt_format)
-                }
+            fields = {}
+            icalToDict(event, fields)
 
-                icalToDict(event, event_data)
+            for revent in rule.between(time_min, time_max):
+                if "uid" in event:
+                    fields["uid"] = occurrenceUid(str(event.get("uid")), revent)
 
-                event_list.append((event, event_data))
+                event_list.append((event, Event(start=revent, end=revent + duration, tz=tz, **fields)))
 
         else:
             dtstart = event.get('dtstart').dt
@@ -152,127 +753,168 @@ def parseIcalOld(url):
             except AttributeError:
                 dtend = dtstart
 
-            if type(dtstart) is date:
-                event_data = {
-                    "start": dtstart.strftime(dt_format),
-                    "end": dtend.strftime(dt_format),
-                    "allDay": True
-                }
-
-            else:
+            all_day = type(dtstart) is date
+            if not all_day:
                 if dtstart.tzinfo:
                     dtstart = dtstart.astimezone(tz)
                 if dtend.tzinfo:
                     dtend = dtend.astimezone(tz)
 
-                event_data = {
-                    "start": dtstart.strftime(dt_format),
-                    "end": dtend.strftime(dt_format)
-                }
-
-            icalToDict(event, event_data)
+            fields = {}
+            if "uid" in event and "recurrence-id" in event:
+                fields["uid"] = occurrenceUid(str(event.get("uid")), event.get("recurrence-id").dt)
+            elif "uid" in event:
+                fields["uid"] = str(event.get("uid"))
+
+            icalToDict(event, fields)
+
+            event_list.append((event, Event(start=dtstart, end=dtend, tz=tz, all_day=all_day, **fields)))
+
+    return resolveModifiedRecurrences(event_list)
+
+def resolveModifiedRecurrences(event_list):
+    """
+    Takes a list of (component, Event) tuples, and drops every occurrence
+    of a recurring event that has been replaced by an instance with a
+    RECURRENCE-ID on the same day. Occurrences are indexed by UID and day, so
+    each event is only looked at once. Returns the list of Events.
+    """
+    resolved = {}
+    for event, event_data in event_list:
+        key = (event.get('uid'), event_data.start.date())
+        if key in resolved and "RECURRENCE-ID" not in event:
+            # either a duplicate, or the updated instance came first
+            continue
+        resolved[key] = event_data
 
-            event_list.append((event, event_data))
-
-    # Function for reduce operation below
-    def check_for_modified_reoccurences(old_items, new_item):
-        # check all events for duplicate UIDs
-        for n, item in enumerate(old_items):
-            # ignore events not on the same day
-            if datetime.strptime(item[1]["start"], dt_format).date() != datetime.strptime(new_item[1]["start"], dt_format).date():
-                continue
-            if item[0].get('uid') == new_item[0].get('uid'):
-                # Duplicate UID found
-                # The original item has no "RECURRENCE-ID" set, the updated one does
-                if "RECURRENCE-ID" in new_item[0]:
-                    # new item the updated one
-                    # remove the old entry, fill in the new one
-                    del old_items[n]
-                    old_items.append(new_item)
-                # if the old one is the updated one, just ignore the new item and move on
-                return old_items
-
-        # first item, or simply duplicate UIDs found
-        old_items.append(new_item)
-        return old_items
-
-    # filter modified recurrences
-    event_list = reduce(check_for_modified_reoccurences, event_list, [])
-    # pass on only the second part of the tuples, the event_data
-    event_list = [x[1] for x in event_list]
-    return event_list
+    return list(resolved.values())
 
 # -------------------------------------------------------------
 #  Get all events from a specific Eventbrite organizer
 # -------------------------------------------------------------
 
+# Venue addresses are shared by all organizers and kept between runs
+venue_cache = None
+venue_cache_lock = threading.Lock()
+venue_cache_ttl = getattr(config, "EVENTBRITE_VENUE_CACHE_DAYS", 7) * 24 * 3600
+
+def resolveVenues(eventbrite, venue_ids):
+    """
+    Returns a dict mapping venue_ids to their address. Venues that are not
+    cached, or whose cache entry expired, are looked up concurrently.
+    """
+    global venue_cache
+    filename = cache_directory + "/eventbrite_venues.json"
+    now = time.time()
+
+    with venue_cache_lock:
+        if venue_cache is None:
+            venue_cache = {}
+            if fetch_cache:
+                try:
+                    venue_cache = json.loads(readCacheFile(filename))
+                except (TypeError, ValueError):
+                    pass
+        missing = [v for v in venue_ids if v not in venue_cache or now - venue_cache[v]["fetched"] > venue_cache_ttl]
+
+    for venue_id in set(venue_ids) - set(missing):
+        recordCacheHit()
+
+    def lookup(venue_id):
+        try:
+            venue = json.loads(archived("eventbrite:/venues/%s" % venue_id,
+                    lambda: eventbriteGet(eventbrite, "/venues/%s/" % venue_id)))
+            return "%s, %s, %s %s" % (venue["name"], venue["address"]["address_1"], venue["address"]["postal_code"], venue["address"]["city"])
+        except Exception:
+            return None
+
+    if missing:
+        # looked up in parallel, so count them as one request
+        start = time.monotonic()
+        with ThreadPoolExecutor(max_workers=fetch_concurrency) as executor:
+            found = dict(zip(missing, executor.map(inSource(lookup), missing)))
+        recordFetch(time.monotonic() - start)
+
+        with venue_cache_lock:
+            for venue_id, venue_str in found.items():
+                # failed lookups are tried again on the next run, meanwhile
+                # an expired address is still better than none
+                if venue_str is not None:
+                    venue_cache[venue_id] = {"location": venue_str, "fetched": now}
+            if fetch_cache:
+                writeCacheFile(filename, json.dumps(venue_cache).encode("utf-8"))
+
+    with venue_cache_lock:
+        return {v: venue_cache[v]["location"] if v in venue_cache else "" for v in venue_ids}
+
+def eventbriteGet(eventbrite, path, params={}):
+    """
+    GET path from the API of an Eventbrite client, like its get() does but
+    with a timeout. Returns the body.
+    """
+    import requests
+    from eventbrite.utils import format_path
+
+    headers = dict(eventbrite.headers)
+    headers.pop("content-type", None)
+    res = requests.get(format_path(path, eventbrite.eventbrite_api_url), headers=headers,
+                       params=dict(params, expand="none"), timeout=fetch_timeout)
+    res.raise_for_status()
+    return res.content
+
 def parseEventbrite(organizer):
+    from eventbrite import Eventbrite
+
     eventbrite = Eventbrite(config.EVENTBRITE_OAUTH_TOKEN)
     events = []
 
-    data = eventbrite.get_organizer_events(organizer)
-    events = events + data["events"]
+    def get(**kwargs):
+        start = time.monotonic()
+        key = "eventbrite:/organizers/%s/events/?%s" % (organizer, urllib.parse.urlencode(kwargs))
+        data = archived(key, lambda: eventbriteGet(eventbrite, "/organizers/%s/events/" % organizer, kwargs))
+        recordFetch(time.monotonic() - start, len(data))
+        return json.loads(data)
+
+    data = get()
+    events.extend(data["events"])
 
     while data["pagination"]["has_more_items"]:
-        data = eventbrite.get_organizer_events(organizer, continuation=data["pagination"]["continuation"])
-        events = events + data["events"]
+        data = get(continuation=data["pagination"]["continuation"])
+        events.extend(data["events"])
+
+    venues = resolveVenues(eventbrite, set(event["venue_id"] for event in events if event.get("venue_id")))
 
     event_list = []
-    venues = {}
     for event in events:
-        event_data = {
-            "title": event["name"]["text"],
-            "start": event["start"]["local"],
-            "end": event["end"]["local"],
-            "url": event["url"]
-        }
-
         try:
-            event_data["description"] = event["description"]["text"]
+            description = event["description"]["text"]
         except AttributeError:
-            pass
-
-        venue_id = event["venue_id"]
-        if venue_id in venues:
-            venue_str = venues[venue_id]
-        else:
-            try:
-                venue = eventbrite.get("/venues/%s" % venue_id)
-                venue_str = "%s, %s, %s %s" % (venue["name"], venue["address"]["address_1"], venue["address"]["postal_code"], venue["address"]["city"])
-            except:
-                venue_str = ""
-            venues[venue_id] = venue_str
-
-
-        event_data["location"] = venue_str
+            description = None
 
-        event_list.append(event_data)
+        # local times, without an offset
+        event_list.append(Event(event["name"]["text"], event["start"]["local"], event["end"]["local"], tz,
+            description=description,
+            location=venues.get(event.get("venue_id"), ""),
+            url=event["url"],
+            uid=event["id"]))
 
     return event_list
 
 def parseFacebookPage(pageid):
-    url = "https://graph.facebook.com/v2.10/%s/events?time_filter=upcoming&access_token=%s" % (pageid, config.FACEBOOK_TOKEN)
-    req = urllib.request.Request(url)
+    url = "https://graph.facebook.com/v2.10/%s/events?time_filter=upcoming" % pageid
+    req = urllib.request.Request("%s&access_token=%s" % (url, config.FACEBOOK_TOKEN))
     try:
-        response = urllib.request.urlopen(req)
+        # recorded without the token
+        data_raw = archived(url, lambda: urllib.request.urlopen(req, timeout=fetch_timeout).read())
     except urllib.error.URLError as err:
-        logger.error("Error while fetching %s: %s" % (url, err.msg))
+        logger.error("Error while fetching %s: %s" % (url, err.reason))
         raise
 
-    data_raw = response.read()
     data = json.loads(data_raw)
 
     event_list = []
 
     for fb_event in data["data"]:
-        start_time, _ = fb_event["start_time"].split('+')
-        try:
-            end_time, _ = fb_event["end_time"].split('+')
-        except:
-            # Some events dont have an endtime
-            end_time_tmp = parse(start_time) + timedelta(hours = 1)
-            end_time = end_time_tmp.strftime(dt_format)
-
         try:
             location = "%s (%s, %s %s)" % (
                 fb_event["place"]["name"],
@@ -285,267 +927,1358 @@ def parseFacebookPage(pageid):
             except:
                 location = ""
 
-        event_data = {
-            "title": fb_event["name"],
-            "description": fb_event["description"],
-            "start": start_time,
-            "end": end_time,
-            "location": location,
-            "url": "https://www.facebook.com/events/%s" % fb_event["id"]
-        }
-
-        if "event_times" in fb_event:
-            for event_time in fb_event["event_times"]:
-                event_data_rec = event_data.copy()
-                event_data_rec["url"] = "https://www.facebook.com/events/%s" % event_time["id"]
-                event_data_rec["start"], _ = event_time["start_time"].split('+')
-                try:
-                    event_data_rec["end"], _ = event_time["end_time"].split('+')
-                except:
-                    end_time_tmp = parse(event_data_rec["start"]) + timedelta(hours = 1)
-                    event_data_rec["end"] = end_time_tmp.strftime(dt_format)
-                event_list.append(event_data_rec)
-        else:
-            event_list.append(event_data)
+        # Some events dont have an endtime, they take an hour
+        for event_time in fb_event.get("event_times", [fb_event]):
+            event_list.append(Event(fb_event["name"], event_time["start_time"], event_time.get("end_time"), tz,
+                description=fb_event["description"],
+                location=location,
+                url="https://www.facebook.com/events/%s" % event_time["id"],
+                uid=event_time["id"]))
 
     if len(event_list) == 0:
         event_list=parseFacebookPageFallback(pageid)
 
     return event_list
 
-def parseFacebookPageFallback(pageid):
+# Event pages are scraped from mbasic.facebook.com with this many requests in
+# parallel, starting at most one every FACEBOOK_REQUEST_INTERVAL seconds for
+# all pages together, and scraped again after FACEBOOK_EVENT_CACHE_HOURS
+facebook_concurrency = getattr(config, "FACEBOOK_CONCURRENCY", 4)
+facebook_request_interval = getattr(config, "FACEBOOK_REQUEST_INTERVAL", 1.0)
+facebook_event_cache_ttl = getattr(config, "FACEBOOK_EVENT_CACHE_HOURS", 24) * 3600
+
+# Keep the list of events of every page in cache/debug.<page_id>.html
+facebook_debug = getattr(config, "FACEBOOK_DEBUG", False)
+
+facebook_cache = None
+facebook_cache_lock = threading.Lock()
+facebook_next_request = 0.0
+facebook_throttle_lock = threading.Lock()
+
+def facebookThrottle():
+    """ Waits until the next request to Facebook may be started """
+    global facebook_next_request
+    with facebook_throttle_lock:
+        now = time.monotonic()
+        wait = facebook_next_request - now
+        facebook_next_request = max(now, facebook_next_request) + facebook_request_interval
+    if wait > 0:
+        time.sleep(wait)
+
+def facebookEventKey(url):
+    """ The id of the event of a page, and of the date for events with several """
+    m = re.search(r"/events/(\d+)", url)
+    if not m:
+        return url
+    n = re.search(r"event_time_id=(\d+)", url)
+    return "%s/%s" % (m.group(1), n.group(1)) if n else m.group(1)
+
+def uniqueEventUrls(urls):
+    """ The first url of every event, links to the same event differ in their query """
+    unique = {}
+    for url in urls:
+        unique.setdefault(facebookEventKey(url), url)
+    return list(unique.values())
+
+facebook_time_formats = [
+    # e.g. "Freitag, 20. September 2019 von 12:00 bis 14:00 UTC+02"
+    (re.compile(r"(\w*), (\d*)\. (\w* \d*) von (\S*) bis (\S*) (UTC\+\d\d)"),
+        lambda m: ("%s, %s. %s %s %s00" % (m.group(1), m.group(2), m.group(3), m.group(4), m.group(6)),
+                   "%s, %s. %s %s %s00" % (m.group(1), m.group(2), m.group(3), m.group(5), m.group(6)))),
+    (re.compile(r"(\w*), (\d* \w*)\. (\w*) um (\S*) (UTC\+\d\d)"),
+        lambda m: ("%s, %s. %s %s %s00" % (m.group(1), m.group(2), m.group(3), m.group(4), m.group(5)), None)),
+    # e.g. "Freitag, 20. September 2019 um 12:00 UTC+02"
+    (re.compile(r"(\w*), (\d*)\. (\w*) (\w*) um (\S*) (UTC\+\d\d)"),
+        lambda m: ("%s, %s. %s %s %s %s00" % (m.group(1), m.group(2), m.group(3), m.group(4), m.group(5), m.group(6)), None)),
+    (re.compile(r"(\d*)\. (\w*) um (\S*) . (\d*)\. (\w*) um (\S*) (UTC\+\d\d)"),
+        lambda m: ("%s. %s %s %s00" % (m.group(1), m.group(2), m.group(3), m.group(7)),
+                   "%s. %s %s %s00" % (m.group(4), m.group(5), m.group(6), m.group(7)))),
+]
 
-    def _parseEventPages(event_urls):
-        event_list = []
-        for url in event_urls:
-            try:
-                res = ses.get(url)
-                c = BeautifulSoup(res.content,"html.parser")
-                title = c.title.text
-                subevents = c.find_all("a",{"href":re.compile(r"event_time_id=\d*")})
+def parseFacebookPageFallback(pageid):
+    """
+    Scrapes the events of a page from mbasic.facebook.com. The event pages
+    are fetched concurrently and kept in cache/facebook_events.json by event
+    id, so only new events and those not scraped for a while are fetched.
+    """
+    from bs4 import BeautifulSoup
+    import requests
+    import dateparser
+
+    global facebook_cache
+    filename = cache_directory + "/facebook_events.json"
+
+    def parseEventPage(content, url):
+        """ Returns the events on an event page, or the urls of its sub events """
+        c = BeautifulSoup(content, "html.parser")
+        title = c.title.text
+        # the pages of the dates of an event link to each other
+        subevents = "event_time_id=" not in url and c.find_all("a",{"href":re.compile(r"event_time_id=\d*")})
+        if subevents:
+            logger.debug("[%s] %s has subevents" % (pageid,title))
+            return {"subevents": ["https://mbasic.facebook.com%s" % subevent["href"] for subevent in subevents]}
+
+        times = c.find("div",string=re.compile(r".*UTC\+\d\d")).string
+        for pattern, dates in facebook_time_formats:
+            m = pattern.match(times)
+            if m:
+                break
+        else:
+            logger.error("[%s] %s does not match time filter" % (pageid,title))
+            return {"events": []}
 
-                if subevents:
-                    logger.warning("[%s] %s has subevents" % (pageid,title))
-                    subevent_urls = ["https://mbasic.facebook.com%s" % subevent["href"] for subevent in subevents]
+        start_text, end_text = dates(m)
+        start = dateparser.parse(start_text)
+        end = dateparser.parse(end_text) if end_text else None
+        id = re.search(r"/events/(\d*)",url).group(1)
 
-                    subevent_list = _parseEventPages(subevent_urls)
-                    event_list += subevent_list
-                    continue
+        # kept in the cache as they are written
+        return {"events": [Event(title, start, end, tz,
+            url="https://www.facebook.com/events/%s" % id,
+            uid=facebookEventKey(url)).toDict()]}
 
-                times = c.find("div",string=re.compile(r".*UTC\+\d\d")).string
-                #m = re.match("(\w*), (\d*)\. (\w*) (\S*) - (\S*) (UTC\+\d\d)", times)
-                m = re.match(r"(\w*), (\d*)\. (\w* \d*) von (\S*) bis (\S*) (UTC\+\d\d)", times)
-                if m:
-                    start = dateparser.parse("%s, %s. %s %s %s00" % (m.group(1), m.group(2), m.group(3), m.group(4), m.group(6)))
-                    end = dateparser.parse("%s, %s. %s %s %s00" % (m.group(1), m.group(2), m.group(3), m.group(5), m.group(6)))
-                else:
-                    m = re.match(r"(\w*), (\d* \w*)\. (\w*) um (\S*) (UTC\+\d\d)", times)
-                    if m:
-                        start = dateparser.parse("%s, %s. %s %s %s00" % (m.group(1), m.group(2), m.group(3), m.group(4), m.group(5)))
-                        end = start + timedelta(hours = 1)
-                    else:
-                        # e.g. "Freitag, 20. September 2019 um 12:00 UTC+02"
-                        m = re.match(r"(\w*), (\d*)\. (\w*) (\w*) um (\S*) (UTC\+\d\d)", times)
-                        if m:
-                            start = dateparser.parse("%s, %s. %s %s %s %s00" % (m.group(1), m.group(2), m.group(3), m.group(4), m.group(5), m.group(6)))
-                            end = start + timedelta(hours = 1)
-                        else:
-                            m = re.match(r"(\d*)\. (\w*) um (\S*) . (\d*)\. (\w*) um (\S*) (UTC\+\d\d)", times)
-                            if m:
-                                start = dateparser.parse("%s. %s %s %s00" % (m.group(1), m.group(2), m.group(3), m.group(7)))
-                                end = dateparser.parse("%s. %s %s %s00" % (m.group(4), m.group(5), m.group(6), m.group(7)))
-                            else:
-                                logger.error("[%s] %s does not match time filter" % (pageid,title))
-                                continue
-                id = re.search(r"/events/(\d*)",url).group(1)
-            except Exception as e:
-                exc_type, exc_obj, exc_tb = sys.exc_info()
-                fname = os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
-                logger.error("[%s] %s (%s,%s,%s)" % (pageid,e,fname,exc_tb.tb_lineno,url))
-                continue
-            event_data = {
-                "title": title,
-                #"description": "",
-                "start": start.strftime(dt_format),
-                "end": end.strftime(dt_format),
-                #"location": location,
-                #"url": url
-                "url": "https://www.facebook.com/events/%s" % id
-            }
-            #print ("* %s (%s)" % (event_data["title"], id))
+    def fetch(url):
+        facebookThrottle()
+        res = ses.get(url, timeout=fetch_timeout)
+        res.raise_for_status()
+        return res.content
 
-            event_list.append(event_data)
+    def get(url):
+        return archived(url, lambda: fetch(url))
 
-        return event_list
+    def scrape(url):
+        try:
+            return parseEventPage(get(url), url)
+        except Exception as e:
+            exc_type, exc_obj, exc_tb = sys.exc_info()
+            fname = os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
+            logger.error("[%s] %s (%s,%s,%s)" % (pageid,e,fname,exc_tb.tb_lineno,url))
+            return None
+
+    with facebook_cache_lock:
+        if facebook_cache is None:
+            facebook_cache = {}
+            if fetch_cache:
+                try:
+                    facebook_cache = json.loads(readCacheFile(filename))
+                except (TypeError, ValueError):
+                    pass
 
     url="https://mbasic.facebook.com/%s/events/" % pageid
     user_agent = {'user-agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_13_3) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/66.0.3359.181 Safari/537.36', "accept-language": "de-DE,de"}
     ses = requests.Session()
     ses.headers = user_agent
-    res = ses.get(url)
-    c = BeautifulSoup(res.content,"html.parser")
+    ses.mount("https://", requests.adapters.HTTPAdapter(pool_maxsize=facebook_concurrency))
+
+    start = time.monotonic()
+    content = get(url)
+    recordFetch(time.monotonic() - start, len(content))
+    c = BeautifulSoup(content,"html.parser")
     events = c.find_all("a", {"href":re.compile("/events/.*")})
-    event_urls = ["https://mbasic.facebook.com%s" % event["href"] for event in events]
+    event_urls = uniqueEventUrls("https://mbasic.facebook.com%s" % event["href"] for event in events)
+
+    if facebook_debug:
+        writeCacheFile("%s/debug.%s.html" % (cache_directory, pageid), content)
 
-    event_list = _parseEventPages(event_urls)
+    event_list = []
+    seen = set()
+    while event_urls:
+        seen.update(facebookEventKey(u) for u in event_urls)
+        now = time.time()
+        with facebook_cache_lock:
+            pages = {u: facebook_cache[facebookEventKey(u)] for u in event_urls
+                     if now - facebook_cache.get(facebookEventKey(u), {}).get("fetched", 0) <= facebook_event_cache_ttl}
+        for u in pages:
+            recordCacheHit()
+
+        missing = [u for u in event_urls if u not in pages]
+        if missing:
+            # scraped in parallel, so count them as one request
+            start = time.monotonic()
+            with ThreadPoolExecutor(max_workers=facebook_concurrency) as executor:
+                scraped = dict(zip(missing, executor.map(inSource(scrape), missing)))
+            recordFetch(time.monotonic() - start)
+
+            with facebook_cache_lock:
+                for u, page in scraped.items():
+                    # failed pages are tried again on the next run
+                    if page is not None:
+                        pages[u] = facebook_cache[facebookEventKey(u)] = dict(page, fetched=now)
+                for key in [k for k, page in facebook_cache.items() if now - page["fetched"] > facebook_event_cache_ttl]:
+                    del facebook_cache[key]
+                if fetch_cache:
+                    writeCacheFile(filename, json.dumps(facebook_cache).encode("utf-8"))
+
+        subevent_urls = []
+        for u in event_urls:
+            if u in pages:
+                event_list += [Event.fromDict(event, tz) for event in pages[u].get("events", [])]
+                subevent_urls += pages[u].get("subevents", [])
+        event_urls = [u for u in uniqueEventUrls(subevent_urls) if facebookEventKey(u) not in seen]
 
-    filename = "debug.%s.html" % pageid
-    f = open(filename, "w")
-    f.buffer.write(res.content)
-    f.close()
     return event_list
 
 def parseMicrodata(url):
-    req = urllib.request.Request(url)
-    try:
-        response = urllib.request.urlopen(req)
-    except urllib.error.URLError as err:
-        logger.error("Error while fetching %s: %s" % (url, err.msg))
-        raise
+    return fetchAndParse(url, "schema-v3", lambda data: list(schemaEvents(data, url)))
 
-    items = microdata.get_items(response)
+# -------------------------------------------------------------
+#  schema.org Events in HTML, as microdata or JSON-LD
+# -------------------------------------------------------------
 
-    logger.debug("Found %s microdata items" % len(items))
+def isSchemaEvent(types):
+    """ Event and its subtypes, like MusicEvent, in any notation """
+    if not isinstance(types, list):
+        types = [types]
+    return any(isinstance(t, str) and t.rsplit("/", 1)[-1].endswith("Event") for t in types)
+
+class SchemaParser(HTMLParser):
+    """
+    Collects schema.org Events from a page in one pass, as microdata items
+    and from JSON-LD scripts, into self.events as JSON-LD style dicts. Text
+    is only kept within properties of items and JSON-LD scripts, the content
+    of styles, SVG images and templates is skipped.
+    """
+    void_tags = {"area", "base", "br", "col", "embed", "hr", "img", "input",
+                 "link", "meta", "param", "source", "track", "wbr"}
+    skipped_tags = {"style", "svg", "template"}
+    url_attributes = {"a": "href", "area": "href", "link": "href", "audio": "src",
+                      "embed": "src", "iframe": "src", "img": "src", "source": "src",
+                      "track": "src", "video": "src", "object": "data"}
+
+    def __init__(self):
+        HTMLParser.__init__(self, convert_charrefs=True)
+        self.events = []
+        self.stack = []
+        self.texts = []
+        self.skipping = None
+        self.skip_depth = 0
+        self.script = None
+
+    def handle_starttag(self, tag, attrs):
+        if self.skipping:
+            if tag == self.skipping:
+                self.skip_depth += 1
+            return
+        if tag in self.skipped_tags:
+            self.skipping, self.skip_depth = tag, 1
+            return
+
+        attrs = dict(attrs)
+        if tag == "script":
+            # other scripts are ignored, but still have to be closed
+            self.script = [] if (attrs.get("type") or "").strip().lower() == "application/ld+json" else False
+            return
+
+        parent = next((entry["item"] for entry in reversed(self.stack) if entry["item"] is not None), None)
+        props = (attrs.get("itemprop") or "").split() if parent is not None else []
+        entry = {"tag": tag, "item": None, "parent": parent, "props": props, "text": None}
+
+        if "itemscope" in attrs:
+            entry["item"] = {"@type": (attrs.get("itemtype") or "").split()}
+        elif props:
+            if tag == "meta":
+                value = attrs.get("content")
+            elif tag in self.url_attributes:
+                value = attrs.get(self.url_attributes[tag])
+            elif tag in ("time", "data", "meter") and (attrs.get("datetime") or attrs.get("value")):
+                value = attrs.get("datetime") or attrs.get("value")
+            else:
+                value = None
+                entry["text"] = []
+                self.texts.append(entry["text"])
+            if entry["text"] is None:
+                self.addProperty(parent, props, value or "")
+
+        if tag in self.void_tags:
+            self.closeEntry(entry)
+        else:
+            self.stack.append(entry)
+
+    def handle_endtag(self, tag):
+        if self.skipping:
+            if tag == self.skipping:
+                self.skip_depth -= 1
+                if self.skip_depth == 0:
+                    self.skipping = None
+            return
+
+        if tag == "script":
+            if self.script:
+                try:
+                    self.findJsonEvents(json.loads("".join(self.script)))
+                except ValueError:
+                    pass
+            self.script = None
+            return
+
+        # end tags that were never opened are ignored, unclosed ones are
+        # closed with their parent
+        if not any(entry["tag"] == tag for entry in self.stack):
+            return
+        while True:
+            entry = self.stack.pop()
+            self.closeEntry(entry)
+            if entry["tag"] == tag:
+                break
+
+    def handle_data(self, data):
+        if self.skipping:
+            return
+        if self.script is not None:
+            if self.script is not False:
+                self.script.append(data)
+            return
+        for text in self.texts:
+            text.append(data)
+
+    def close(self):
+        HTMLParser.close(self)
+        while self.stack:
+            self.closeEntry(self.stack.pop())
+
+    def closeEntry(self, entry):
+        if entry["text"] is not None:
+            self.texts.remove(entry["text"])
+            self.addProperty(entry["parent"], entry["props"], " ".join("".join(entry["text"]).split()))
+        if entry["item"] is not None:
+            if entry["props"]:
+                self.addProperty(entry["parent"], entry["props"], entry["item"])
+            if isSchemaEvent(entry["item"]["@type"]):
+                self.events.append(entry["item"])
+
+    def addProperty(self, item, props, value):
+        # the first value of a property wins, as with JSON-LD
+        for prop in props:
+            item.setdefault(prop, value)
+
+    def findJsonEvents(self, node):
+        if isinstance(node, list):
+            for child in node:
+                self.findJsonEvents(child)
+        elif isinstance(node, dict):
+            if isSchemaEvent(node.get("@type")):
+                self.events.append(node)
+            for child in node.values():
+                self.findJsonEvents(child)
+
+def schemaText(value):
+    """ The text of a property, which may be a list of values or an item """
+    if isinstance(value, list):
+        value = value[0] if value else None
+    if isinstance(value, dict):
+        value = value.get("name") or value.get("@id")
+    # JSON-LD is often escaped like the HTML around it
+    return unescape(value) if isinstance(value, str) else None
+
+def schemaLocation(value):
+    """ Name and address of a Place, or the text of the location """
+    if isinstance(value, list):
+        value = value[0] if value else None
+    if not isinstance(value, dict):
+        return schemaText(value) or ""
+
+    address = value.get("address")
+    if isinstance(address, dict):
+        locality = " ".join(x for x in (schemaText(address.get("postalCode")), schemaText(address.get("addressLocality"))) if x)
+        address = ", ".join(x for x in (schemaText(address.get("streetAddress")), locality) if x)
+    else:
+        address = schemaText(address)
+    return ", ".join(x for x in (schemaText(value.get("name")), address) if x)
+
+def schemaTime(value):
+    """
+    Parses an ISO 8601 date or date and time. Times without an offset are
+    local time, a date without a time is an all day event. Returns the time
+    in local time and whether it's a date.
+    """
+    from dateutil.parser import isoparse, parse
+
+    value = value.strip()
+    if re.match(r"^\d{4}-\d{2}-\d{2}$", value):
+        return tz.localize(datetime.strptime(value, "%Y-%m-%d")), True
 
-    event_list = []
+    try:
+        dt = isoparse(value)
+    except ValueError:
+        dt = parse(value)
+    if dt.tzinfo is None:
+        return tz.localize(dt), False
+    return dt.astimezone(tz), False
+
+def schemaEvents(data, url):
+    """
+    Generates the events of a page, in microdata and JSON-LD. The page is
+    decoded and parsed in chunks, and events are passed on as they are found.
+    """
+    m = re.search(rb"""<meta[^>]+charset=["']?([\w-]+)""", data[:2048], re.I)
+    try:
+        decoder = codecs.getincrementaldecoder(m.group(1).decode("ascii") if m else "utf-8")(errors="replace")
+    except LookupError:
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+
+    parser = SchemaParser()
+    seen = set()
+    # the chunks of the page, and an empty one last to flush the decoder and
+    # the parser
+    chunks = (data[n:n + 65536] for n in range(0, len(data), 65536))
+    for chunk in itertools.chain(chunks, [b""]):
+        if chunk:
+            parser.feed(decoder.decode(chunk))
+        else:
+            parser.feed(decoder.decode(b"", final=True))
+            parser.close()
 
-    for ev in [x for x in items if microdata.URI("http://schema.org/Event") in x.itemtype or microdata.URI("https://schema.org/Event") in x.itemtype]:
-        try:
-            #start = datetime.strptime(ev.startDate, "%Y-%m-%dT%H:%M:%SZ")
-            start = parse(ev.startDate)
-            #start = start.replace(tzinfo=timezone("UTC")).astimezone(tz)
-
-            if (ev.endDate):
-                #end = datetime.strptime(ev.endDate, "%Y-%m-%dT%H:%M:%SZ")
-                end = parse(ev.endDate)
-                #end = end.replace(tzinfo=timezone("UTC"))
-            else:
-                end = start + timedelta(hours = 1)
-
-            event_data = {
-                "title": ev.name,
-                "description": ev.name,
-                "start": start.strftime(dt_format),
-                "end": end.strftime(dt_format),
-                "location": ev.location.name,
-                "url": urljoin (url, str(ev.url))
-            }
-        except Exception as err:
-            logger.error("Error parsing MicroData event: %s" % err)
-            continue
+        for node in parser.events:
+            title = schemaText(node.get("name"))
+            if not title or not schemaText(node.get("startDate")):
+                logger.debug("Skipping schema.org event without name or start: %s" % title)
+                continue
 
-        event_list.append(event_data)
+            try:
+                start, all_day = schemaTime(schemaText(node.get("startDate")))
+                end = None
+                if schemaText(node.get("endDate")):
+                    end, end_all_day = schemaTime(schemaText(node.get("endDate")))
+                    if end_all_day:
+                        # the end date is inclusive
+                        end = end.date() + timedelta(days = 1)
+            except Exception as err:
+                logger.error("Error parsing schema.org event: %s" % err)
+                continue
 
-    return event_list
+            # pages often have the same events as microdata and JSON-LD
+            if (title, start) in seen:
+                continue
+            seen.add((title, start))
+
+            yield Event(title, start, end, tz, all_day=all_day,
+                description=schemaText(node.get("description")) or title,
+                location=schemaLocation(node.get("location")),
+                url=urljoin(url, schemaText(node.get("url"))) if schemaText(node.get("url")) else None)
+        parser.events = []
 
 # -------------------------------------------------------------
 #  parse an event source
 # -------------------------------------------------------------
 
+# Handlers for every source type. A handler gets the config of a source and
+# returns its events, as Events or as dicts like those in the JSON files.
+# Instead of a function, a handler can be given as "module:function", which
+# is only imported once a source of that type is fetched. SOURCE_TYPES in the
+# config adds such handlers for custom types.
+source_types = dict(getattr(config, "SOURCE_TYPES", None) or {})
+source_types_lock = threading.Lock()
+
+def sourceType(name):
+    """ Decorator registering a function as the handler for a source type """
+    def register(handler):
+        source_types.setdefault(name, handler)
+        return handler
+    return register
+
+def sourceHandler(name):
+    with source_types_lock:
+        try:
+            handler = source_types[name]
+        except KeyError:
+            raise ValueError("Unknown source type '%s'" % name)
+
+        if isinstance(handler, str):
+            module_name, function_name = handler.split(":")
+            handler = getattr(importlib.import_module(module_name), function_name)
+            source_types[name] = handler
+
+    return handler
+
+@sourceType("eventbrite")
+def eventbriteSource(source):
+    return parseEventbrite(source["organizer"])
+
+@sourceType("ics")
+def icsSource(source):
+    return parseIcal(source["url"])
+
+@sourceType("facebook")
+def facebookSource(source):
+    return parseFacebookPageFallback(source["page_id"])
+
+@sourceType("microdata")
+def microdataSource(source):
+    return parseMicrodata(source["url"])
+
+@sourceType("multiple")
+def multipleSource(source):
+    events = []
+    for child in source["sources"]:
+        events += getEvents(child)
+    return events
+
 def getEvents(source):
-    if source["type"] == "eventbrite":
-        return parseEventbrite(source["organizer"])
-    elif source["type"] == "ics":
-        return parseIcal(source["url"])
-    elif source["type"] == "facebook":
-        return []
-        #return parseFacebookPageFallback(source["page_id"])
-    elif source["type"] == "microdata":
-        return parseMicrodata(source["url"])
-    elif source["type"] == "multiple":
-        events = []
-        for source in source["sources"]:
-            events += getEvents(source)
-        return events
+    return [event if isinstance(event, Event) else Event.fromDict(event, tz)
+            for event in sourceHandler(source["type"])(source) or []]
 
 # -------------------------------------------------------------
-#  Parse Event Sources and generate JSON files
+#  State of the sources between runs
 # -------------------------------------------------------------
 
-frontend_sources = []
-all_events = []
+def loadSourceState():
+    # recorded and replayed runs fetch every source, and don't change the
+    # state of the regular runs
+    if archive_mode is not None:
+        return {}
+    try:
+        return json.loads(readCacheFile(cache_directory + "/sources.json"))
+    except (TypeError, ValueError):
+        return {}
+
+def saveSourceState(state):
+    if archive_mode is not None:
+        return
+    writeCacheFile(cache_directory + "/sources.json", json.dumps(state).encode("utf-8"))
+
+class SourceSkipped(Exception):
+    """ Stands in for the events of a failing source that isn't retried yet """
+
+# Runs don't start at exactly the same second, so a retry that is due within
+# this many seconds is made already
+retry_slack = 300
+
+def retryPending(state):
+    """ Whether a failing source still has to wait for its next retry """
+    return state.get("retry_at", 0) - retry_slack > time.time()
+
+def recordSuccess(state):
+    state["last_success"] = time.time()
+    for key in ("failures", "first_failure", "retry_at", "reported_hours"):
+        state.pop(key, None)
+
+def recordFailure(state):
+    """
+    Counts a failed fetch of a source. It is retried on the next run after the
+    first failure, and after that waits RETRY_BACKOFF minutes, doubling with
+    every further failure up to RETRY_BACKOFF_MAX minutes. Returns the time of
+    the next retry, or None.
+    """
+    now = time.time()
+    state["failures"] = state.get("failures", 0) + 1
+    state.setdefault("first_failure", now)
+    if state["failures"] > 1:
+        backoff = min(retry_backoff * 2 ** (state["failures"] - 2), retry_backoff_max)
+        state["retry_at"] = now + 60 * backoff
+    return state.get("retry_at")
 
-directory = os.path.dirname(os.path.realpath(__file__))
+# -------------------------------------------------------------
+#  Track changes of events between runs
+# -------------------------------------------------------------
 
-for source_name, source_config in config.SOURCES.items():
-    filename = "data/" + source_name + ".json"
-    from_cache = False
+def eventUid(source_name, event):
+    """
+    A stable id for an event, from the UID it has in its source, or from its
+    title and start if it has none
+    """
+    key = event.uid or "%s|%s" % (event.title, event.start.strftime(dt_format))
+    return "%s@community_calendar" % hashlib.sha1(("%s|%s" % (source_name, key)).encode("utf-8")).hexdigest()
+
+def eventUids(source_name, events):
+    """
+    The eventUid() of every event of a source. Events that would share one,
+    like the occurrences of a series a source gives the same UID, get the
+    number of their repetition appended to it.
+    """
+    uids = []
+    counts = {}
+    for event in events:
+        uid = eventUid(source_name, event)
+        counts[uid] = counts.get(uid, 0) + 1
+        if counts[uid] > 1:
+            uid = uid.replace("@", "-%d@" % counts[uid], 1)
+        uids.append(uid)
+    return uids
+
+def eventDigest(data):
+    """ Hash of an event as written to the JSON files """
+    return hashlib.sha1(json.dumps(data, sort_keys=True).encode("utf-8")).hexdigest()
+
+def writeChanges(collected):
+    """
+    Compares the events of the collected sources with the last run and adds
+    the events added, changed and removed since then to data/changes.json.
+    Returns a dict mapping the uids of the events of all sources to the time
+    they were last changed, for DTSTAMP. A replayed run doesn't record any
+    changes, the next real run compares with the last real one.
+    """
     try:
-        events = getEvents(source_config)
-    except Exception as e:
-        logger.warning("Could not read source '%s': %s" % (source_config["title"], e))
-        #traceback.print_exc()
-        events = []
+        known = json.loads(readCacheFile(cache_directory + "/events.json"))
+    except (TypeError, ValueError):
+        known = {}
+
+    now = clock()
+    today = datetime.fromtimestamp(now, tz).replace(hour=0, minute=0, second=0, microsecond=0)
+    window_start = (today + timedelta(days = -past_days)).timestamp()
+    added, changed, removed = [], [], []
+    for source_name, source_config, events in collected:
+        before = known.get(source_name, {})
+        after = {}
+        for event, uid in zip(events, eventUids(source_name, events)):
+            data = event.toDict()
+            digest = eventDigest(data)
+            stamp = now
+            if uid not in before:
+                added.append(dict(data, uid=uid, source=source_name))
+            elif before[uid][0] != digest:
+                changed.append(dict(data, uid=uid, source=source_name))
+            else:
+                stamp = before[uid][1]
+            # the end, to tell events that were removed from those that left the window
+            after[uid] = [digest, stamp, event.end_ts]
+
+        # entries of older versions don't have the end, and count as removed
+        removed += [{"uid": uid, "source": source_name} for uid, entry in before.items()
+                    if uid not in after and (len(entry) < 3 or entry[2] > window_start)]
+        known[source_name] = after
+
+    stamps = {uid: entry[1] for events in known.values() for uid, entry in events.items()}
+    if archive_mode == "replay":
+        return stamps
+
+    # the changes first, if the run is interrupted in between they are
+    # listed again next time rather than not at all
+    filename = data_directory + "/changes.json"
+    try:
+        with open(filename) as data_file:
+            history = json.load(data_file)
+    except (OSError, ValueError):
+        history = []
 
-    if not events or len(events) == 0:
-        logger.warning("No events from API for '%s'" % (source_config["title"]))
-        try:
-            t = os.path.getmtime(filename)
-        except:
-            continue
+    history = [entry for entry in history if entry["time"] > now - changes_hours * 3600]
+    if added or changed or removed:
+        history.append({"time": now, "added": added, "changed": changed, "removed": removed})
+    writeOutput(filename, json.dumps(history))
 
-        mdate = datetime.fromtimestamp(t)
-        delta = datetime.now() - mdate
-        delta_hours = floor(delta.total_seconds() / 3600)
-        if delta_hours > 0 and delta_hours % 12 == 0:
-            logger.warning("Source '%s' has been unavailable for %d hours"
-                    % (source_config["title"], delta_hours))
-        from_cache = True
-        with open(directory + "/" + filename) as data_file:
-            events = json.load(data_file)
+    writeCacheFile(cache_directory + "/events.json", json.dumps(known).encode("utf-8"))
 
-    all_events += events
+    return stamps
 
-    if not from_cache:
-        f = open(directory + "/" + filename, "w")
-        f.write(json.dumps(events))
-        f.close
+# -------------------------------------------------------------
+#  Merge duplicate events of different sources
+# -------------------------------------------------------------
+
+def normalizeText(value):
+    """ Lower case words without accents or punctuation, for comparing """
+    value = unicodedata.normalize("NFKD", value or "").encode("ascii", "ignore").decode("ascii")
+    return " ".join(re.findall(r"\w+", value.lower()))
+
+def sourceRank(source_name, source_config):
+    for n, rule in enumerate(dedup_precedence):
+        if rule == source_name or rule == source_config.get("type"):
+            return n
+    return len(dedup_precedence)
+
+def dedupEvents(collected):
+    """
+    Merges events that show up in more than one source. They are indexed by
+    their normalized title and the DEDUP_MINUTES bucket they start in, so each
+    event is only compared to the few with the same title around the same
+    time. Of duplicates at the same location, the event of the source ranked
+    first is kept, and gets the fields it is missing from the others. Events
+    without a location, and those of a single feed, are never merged, the
+    feeds of a "multiple" source are merged with each other. Returns
+    collected with the lists of events of the sources that had duplicates
+    replaced.
+    """
+    if not dedup:
+        return collected
+
+    bucket_seconds = 60 * dedup_minutes
+    index = {}
+    results = {}
+    changed = set()
+    merges = {}
+
+    order = sorted(range(len(collected)), key=lambda n: (sourceRank(*collected[n][:2]), n))
+    for n in order:
+        source_name, source_config, events = collected[n]
+        kept = []
+        for event in events:
+            title = normalizeText(event.title)
+            start = event.start_ts
+            if not title:
+                kept.append(event)
+                continue
+
+            location = normalizeText(event.location)
+            bucket = floor(start / bucket_seconds)
+
+            match = None
+            for key in ((title, bucket - 1), (title, bucket), (title, bucket + 1)):
+                for entry in index.get(key, []):
+                    if (entry["feed"] != (n, event.feed) and abs(entry["start"] - start) <= bucket_seconds
+                            and location and entry["location"] == location):
+                        match = entry
+                        break
+                if match:
+                    break
+
+            if match is None:
+                index.setdefault((title, bucket), []).append({"start": start, "location": location,
+                        "source": n, "feed": (n, event.feed), "position": len(kept)})
+                kept.append(event)
+                continue
+
+            match_name = collected[match["source"]][0]
+            logger.debug("Merging '%s' at %s of '%s' into the one of '%s'"
+                    % (event.title, event.start.strftime(dt_format), source_name, match_name))
+            merges[(n, match["source"])] = merges.get((n, match["source"]), 0) + 1
+
+            # copied before it is changed, the fetched events are kept as
+            # they are in the cache
+            kept_events = results.get(match["source"], kept)
+            kept_event = kept_events[match["position"]]
+            fill = {key: getattr(event, key) for key in ("description", "url")
+                    if getattr(kept_event, key) in (None, "") and getattr(event, key) not in (None, "")}
+            kept_events[match["position"]] = kept_event.copy(**fill)
+            changed.update((n, match["source"]))
 
-    frontend_sources.append({
-        "url": filename,
-        "title": source_config["title"],
-        "color": source_config["color"]
-    })
+        results[n] = kept
+
+    for (n, m), count in merges.items():
+        logger.info("Merged %d events of '%s' into those of '%s'"
+                % (count, collected[n][1].get("title", collected[n][0]), collected[m][1].get("title", collected[m][0])))
+
+    return [(source_name, source_config, results[n] if n in changed else events)
+            for n, (source_name, source_config, events) in enumerate(collected)]
+
+# -------------------------------------------------------------
+
+def writeShards(source_name, events):
+    """
+    Writes events to data/shards/<source_name>/<YYYY-MM>.json, one file for every
+    month an event overlaps, and removes the shards of months that are no
+    longer covered.
+    """
+    months = {}
+    for event in events:
+        start = event.start.astimezone(tz)
+        end = event.end.astimezone(tz)
+        data = event.toDict()
+
+        # end is exclusive, an event until midnight is over by the 1st
+        last = max(start, end - timedelta(microseconds=1))
+        year, month = start.year, start.month
+        while (year, month) <= (last.year, last.month):
+            months.setdefault("%04d-%02d" % (year, month), []).append(data)
+            year, month = (year, month + 1) if month < 12 else (year + 1, 1)
+
+    shard_directory = data_directory + "/shards/" + source_name
+    os.makedirs(shard_directory, exist_ok=True)
+    for month, month_events in months.items():
+        writeOutput("%s/%s.json" % (shard_directory, month), json.dumps(month_events))
+
+    for filename in os.listdir(shard_directory):
+        if filename.endswith(".json") and filename[:-5] not in months:
+            removeOutput(shard_directory + "/" + filename)
+
+def shardManifest(source_name):
+    """ Returns a dict mapping months to the urls of the shards written for a source """
+    try:
+        filenames = os.listdir(data_directory + "/shards/" + source_name)
+    except OSError:
+        return {}
 
-filename = directory + "/data/_sources.json"
-f = open(filename, "w")
-f.write(json.dumps(frontend_sources))
-f.close
+    months = sorted(filename[:-5] for filename in filenames if filename.endswith(".json"))
+    return {month: "data/shards/%s/%s.json" % (source_name, month) for month in months}
 
 # -------------------------------------------------------------
 #  Generate iCal
 # -------------------------------------------------------------
 
-cal = Calendar()
-cal.add('prodid', '-//community_calendar//tiefpunkt//')
-cal.add('version', '2.0')
-cal.add('X-WR-CALNAME', config.ICAL_CALNAME)
+def icalText(value):
+    """ Escapes a TEXT value """
+    return (value.replace("\\", "\\\\").replace(";", "\\;").replace(",", "\\,")
+            .replace("\r\n", "\\n").replace("\r", "\\n").replace("\n", "\\n"))
+
+def icalLine(name, value):
+    """
+    Returns a content line, folded into lines of at most 75 octets without
+    splitting UTF-8 sequences
+    """
+    line = ("%s:%s" % (name, value)).encode("utf-8")
+    if len(line) <= 75:
+        return line + b"\r\n"
+
+    parts = []
+    start, limit = 0, 75
+    while len(line) - start > limit:
+        end = start + limit
+        while line[end] & 0xC0 == 0x80:
+            end -= 1
+        parts.append(line[start:end])
+        # the continuation lines start with a space
+        start, limit = end, 74
+    parts.append(line[start:])
+    return b"\r\n ".join(parts) + b"\r\n"
+
+def icalTime(name, value, all_day=False):
+    """ A DTSTART or DTEND line, with a date for all day events """
+    if all_day:
+        return icalLine(name + ";VALUE=DATE", value.strftime("%Y%m%d"))
+    return icalLine(name, value.astimezone(utc).strftime("%Y%m%dT%H%M%SZ"))
+
+def icalEvent(event, uid, stamp):
+    """ Serializes an event as a VEVENT, stamp is the time it last changed """
+    lines = [
+        b"BEGIN:VEVENT\r\n",
+        icalLine("UID", uid),
+        icalLine("DTSTAMP", datetime.fromtimestamp(stamp, utc).strftime("%Y%m%dT%H%M%SZ"))
+    ]
+    # sources may leave out any of the text fields, or give them as numbers
+    if event.title:
+        lines.append(icalLine("SUMMARY", icalText(str(event.title))))
+    if event.description:
+        lines.append(icalLine("DESCRIPTION", icalText(str(event.description))))
+    if event.url:
+        lines.append(icalLine("URL", str(event.url)))
+    if event.location:
+        lines.append(icalLine("LOCATION", icalText(str(event.location))))
+    lines.append(icalTime("DTSTART", event.start, event.all_day))
+    lines.append(icalTime("DTEND", event.end, event.all_day))
+    lines.append(b"END:VEVENT\r\n")
+    return b"".join(lines)
+
+def icalHeader(calname):
+    return (b"BEGIN:VCALENDAR\r\n"
+            + icalLine("PRODID", "-//community_calendar//tiefpunkt//")
+            + icalLine("VERSION", "2.0")
+            + icalLine("X-WR-CALNAME", icalText(calname)))
+
+ical_footer = b"END:VCALENDAR\r\n"
+
+def icalEvents(source_name, events, stamps={}):
+    """
+    Serializes the events of a source as VEVENTs. stamps maps event uids to
+    the time they last changed, as returned by writeChanges.
+    """
+    now = clock()
+    uids = eventUids(source_name, events)
+    return b"".join(icalEvent(event, uid, stamps.get(uid, now)) for event, uid in zip(events, uids))
+
+def icalFromEvents(events, source_name=""):
+    return icalHeader(config.ICAL_CALNAME) + icalEvents(source_name, events) + ical_footer
 
-for event in all_events:
-    vevent = Event()
-    vevent.add("summary", event["title"])
+# -------------------------------------------------------------
+#  Fetch all event sources concurrently
+# -------------------------------------------------------------
 
-    try:
-        vevent.add("description", event["description"])
-    except KeyError:
-        pass
+def leafSources(source):
+    """ Flatten "multiple" sources into the list of sources to fetch """
+    if source["type"] != "multiple":
+        return [source]
+
+    leaves = []
+    for child in source["sources"]:
+        leaves += leafSources(child)
+    return leaves
+
+# Sources a thread is still fetching for, after the run that started it gave
+# up on it. They aren't fetched again meanwhile, so hanging requests of a
+# long running daemon don't pile up.
+fetching = set()
+fetching_lock = threading.Lock()
+
+def fetchSources(sources, source_state={}):
+    """
+    Fetch all sources with FETCH_CONCURRENCY worker threads. The children of
+    "multiple" sources are fetched as jobs of their own, and merged again in
+    their configured order. Sources backing off after failures according to
+    source_state aren't fetched at all. Returns a dict mapping every source
+    name to its list of events, or to the exception that made one of its
+    fetches fail, and a dict with the metrics of every source.
+
+    Every request has a timeout of its own. A job still running FETCH_TIMEOUT
+    seconds after it started is given up on, and its worker replaced, so the
+    jobs behind it aren't held up. As every worker takes at most that long
+    for a job, all jobs are given up on after as many rounds of them from
+    their submission.
+    """
+    skipped = {name for name in sources if retryPending(source_state.get(name, {}))}
+    with fetching_lock:
+        hanging = set(sources) & fetching - skipped
+        jobs = [(name, leaf) for name, source in sources.items() if name not in skipped | hanging
+                for leaf in leafSources(source)]
+        left = {name: len([job for job in jobs if job[0] == name]) for name in sources}
+        fetching.update(name for name in left if left[name])
+    started = {}
+    outcome = {}
+    job_metrics = [newMetrics() for job in jobs]
+    todo = queue.Queue()
+    finished = queue.Queue()
+
+    def fetch(n):
+        current.metrics = job_metrics[n]
+        current.source = jobs[n][0]
+        try:
+            return getEvents(jobs[n][1]) or []
+        finally:
+            job_metrics[n]["seconds"] = time.monotonic() - started[n]
+            current.metrics = None
+            current.source = None
+            with fetching_lock:
+                left[jobs[n][0]] -= 1
+                if not left[jobs[n][0]]:
+                    fetching.discard(jobs[n][0])
+
+    def worker():
+        while True:
+            try:
+                n = todo.get_nowait()
+            except queue.Empty:
+                return
+            with fetching_lock:
+                if n in outcome:
+                    # given up on before it started
+                    continue
+                started[n] = time.monotonic()
+            try:
+                finished.put((n, fetch(n)))
+            except Exception as e:
+                finished.put((n, e))
+            if n in abandoned:
+                # replaced by another worker meanwhile
+                return
+
+    def startWorker():
+        # daemon threads, a hanging request doesn't keep the process alive
+        threading.Thread(target=worker, daemon=True).start()
+
+    abandoned = set()
+    for n in range(len(jobs)):
+        todo.put(n)
+    for n in range(min(fetch_concurrency, len(jobs))):
+        startWorker()
+    rounds = -(-len(jobs) // fetch_concurrency)
+    deadline = time.monotonic() + fetch_timeout * rounds
+
+    while len(outcome) < len(jobs):
+        try:
+            n, result = finished.get(timeout=1)
+            if n not in outcome:
+                outcome[n] = result
+        except queue.Empty:
+            pass
 
-    try:
-        vevent.add("url", event["url"])
-    except KeyError:
-        pass
+        now = time.monotonic()
+        for n in range(len(jobs)):
+            if n in outcome:
+                continue
+            if n in started and now - started[n] > fetch_timeout:
+                # the thread can't be killed, but it won't take on another job
+                abandoned.add(n)
+                outcome[n] = TimeoutError("no result after %d seconds" % fetch_timeout)
+                job_metrics[n]["seconds"] = now - started[n]
+                startWorker()
+            elif now > deadline:
+                outcome[n] = TimeoutError("not fetched within %d seconds" % (fetch_timeout * rounds))
+
+    with fetching_lock:
+        # jobs given up on before they started never will
+        for n in range(len(jobs)):
+            if n not in started:
+                left[jobs[n][0]] -= 1
+                if not left[jobs[n][0]]:
+                    fetching.discard(jobs[n][0])
+
+    results = {name: [] for name in sources}
+    metrics = {name: newMetrics() for name in sources}
+    for name in skipped:
+        state = source_state[name]
+        results[name] = SourceSkipped("not retried before %s, after %d failures"
+                % (datetime.fromtimestamp(state["retry_at"]).strftime("%Y-%m-%d %H:%M"), state["failures"]))
+        metrics[name]["skipped"] = 1
+    for name in hanging:
+        results[name] = SourceSkipped("still being fetched by an earlier run")
+        metrics[name]["skipped"] = 1
+    feeds = {}
+    for n, (name, leaf) in enumerate(jobs):
+        feed = feeds[name] = feeds.get(name, -1) + 1
+        if isinstance(outcome[n], Exception):
+            job_metrics[n]["errors"] += 1
+        else:
+            job_metrics[n]["events"] = len(outcome[n])
+        job_metrics[n]["parse_seconds"] = max(0.0, job_metrics[n]["seconds"] - job_metrics[n]["fetch_seconds"])
+
+        for key, value in job_metrics[n].items():
+            metrics[name][key] += value
+
+        if isinstance(results[name], Exception):
+            continue
+        if isinstance(outcome[n], Exception):
+            results[name] = outcome[n]
+        elif sources[name]["type"] == "multiple":
+            # duplicates between the feeds are merged, those within one aren't
+            results[name] += [event.copy(feed=feed) for event in outcome[n]]
+        else:
+            results[name] += outcome[n]
+
+    return results, metrics
+
+# -------------------------------------------------------------
+#  Parse Event Sources and generate JSON files
+# -------------------------------------------------------------
+
+# Source names are used in file names next to these
+reserved_source_names = {"all", "tags", "shards", "upcoming", "changes"}
+
+def checkSources(sources):
+    """
+    Returns the sources whose names are safe to use in file names and don't
+    take the name of another output file. The others are left out with an
+    error.
+    """
+    checked = {}
+    for source_name, source_config in sources.items():
+        if source_name in reserved_source_names or not re.match(r"^[A-Za-z0-9][A-Za-z0-9_-]*$", source_name):
+            logger.error("Skipping source '%s': its name is reserved or not a valid file name" % source_name)
+            continue
+        checked[source_name] = source_config
+    return checked
+
+def collectEvents(sources, fetched, metrics, source_state):
+    """
+    Pairs every source with its fetched events and keeps them in the cache.
+    Sources that failed or came back empty fall back to the events of their
+    last successful run, sources without any are left out. Failures are
+    counted in source_state, which is saved afterwards. Returns a list of
+    (source_name, source_config, events) tuples.
+    """
+    collected = []
+
+    for source_name, source_config in sources.items():
+        filename = cache_directory + "/source-" + source_name + ".json"
+        if not os.path.exists(filename):
+            # where the events were kept before merging duplicates
+            filename = data_directory + "/" + source_name + ".json"
+        state = source_state.setdefault(source_name, {})
+        from_cache = False
+        events = fetched[source_name]
+        if isinstance(events, SourceSkipped):
+            logger.info("Skipping source '%s': %s" % (source_config["title"], events))
+            events = []
+        elif isinstance(events, Exception):
+            logger.warning("Could not read source '%s': %s" % (source_config["title"], events))
+            retry_at = recordFailure(state)
+            if retry_at:
+                logger.warning("Source '%s' failed %d times in a row, retrying after %s"
+                        % (source_config["title"], state["failures"],
+                           datetime.fromtimestamp(retry_at).strftime("%Y-%m-%d %H:%M")))
+            events = []
+        elif not events:
+            logger.warning("No events from API for '%s'" % (source_config["title"]))
+
+        if archive_mode == "replay" and not events:
+            # only what was recorded, not the cache of this machine
+            continue
+        if not events or len(events) == 0:
+            try:
+                t = os.path.getmtime(filename)
+            except:
+                continue
+            t = state.get("last_success", t)
+
+            # Warn every 12 hours of unavailability, however often the source
+            # is tried
+            delta_hours = floor((time.time() - t) / 3600)
+            if delta_hours >= 12 and delta_hours // 12 > state.get("reported_hours", 0) // 12:
+                logger.warning("Source '%s' has been unavailable for %d hours"
+                        % (source_config["title"], delta_hours))
+                state["reported_hours"] = delta_hours
+            from_cache = True
+            with open(filename) as data_file:
+                events = [Event.fromDict(event, tz) for event in json.load(data_file)]
+        else:
+            recordSuccess(state)
+
+        metrics[source_name]["stale"] = from_cache
+        metrics[source_name]["events"] = len(events)
+
+        # a replayed run leaves the events of the last real run alone
+        if not from_cache and archive_mode != "replay":
+            writeCacheFile(cache_directory + "/source-" + source_name + ".json",
+                    json.dumps([dict(event.toDict(), feed=event.feed) if event.feed is not None else event.toDict()
+                                for event in events]).encode("utf-8"))
+
+        collected.append((source_name, source_config, events))
+
+    saveSourceState(source_state)
+    return collected
+
+def writeFrontendSources(collected, refreshed=None):
+    """
+    Writes the list of sources for the calendar view, and data/<source>.json
+    and the monthly shards of every source. Only the files of the sources
+    named in refreshed are written again, those of all sources by default.
+    """
+    frontend_sources = []
+    shards = {}
+
+    for source_name, source_config, events in collected:
+        if refreshed is None or source_name in refreshed:
+            writeOutput(data_directory + "/" + source_name + ".json", json.dumps([event.toDict() for event in events]))
+            if output_shards:
+                writeShards(source_name, events)
+        if output_shards:
+            shards[source_name] = shardManifest(source_name)
+
+        frontend_sources.append({
+            "id": source_name,
+            "url": "data/" + source_name + ".json",
+            "title": source_config["title"],
+            "color": source_config["color"],
+            "ics": "data/" + source_name + ".ics"
+        })
+
+    filename = data_directory + "/_sources.json"
+    writeOutput(filename, json.dumps(frontend_sources))
+
+    # The manifest tells the calendar view which monthly shards exist
+    filename = data_directory + "/_shards.json"
+    if output_shards:
+        writeOutput(filename, json.dumps(shards))
+    else:
+        removeOutput(filename)
+
+def writeUpcoming(collected):
+    """ Writes the next events of all sources for the agenda view """
+    today = datetime.fromtimestamp(clock(), tz).replace(hour=0, minute=0, second=0, microsecond=0)
+    horizon = today + timedelta(days = upcoming_days)
+    upcoming = []
+
+    today, horizon = today.timestamp(), horizon.timestamp()
+    for source_name, source_config, events in collected:
+        for event in events:
+            if today <= event.start_ts < horizon:
+                upcoming.append((event.start_ts, source_config["title"], event))
+
+    upcoming.sort(key=lambda x: x[0])
+    filename = data_directory + "/upcoming.json"
+    writeOutput(filename, json.dumps([dict(event.toDict(), source=title)
+                                      for start, title, event in upcoming[:upcoming_events]]))
+
+def writeDays(collected):
+    """
+    Writes the events of today up to DAYS_AHEAD days from now to
+    data/_days.json, bucketed by their local start date, with the title and
+    website of their source and a formatted start time
+    """
+    today = datetime.fromtimestamp(clock(), tz).date()
+    days = {(today + timedelta(days = n)).isoformat(): [] for n in range(days_ahead + 1)}
+
+    for source_name, source_config, events in collected:
+        for event in events:
+            start = event.start.astimezone(tz)
+            bucket = days.get(start.date().isoformat())
+            if bucket is None:
+                continue
+
+            entry = {
+                "title": event.title,
+                "start": event.start.strftime(dt_format),
+                "start_text": start.strftime("%d.%m.%Y %H:%M"),
+                "source": source_config["title"],
+            }
+            if event.url:
+                entry["url"] = event.url
+            if source_config.get("website"):
+                entry["website"] = source_config["website"]
+            bucket.append((event.start_ts, entry))
+
+    for day, bucket in days.items():
+        bucket.sort(key=lambda x: x[0])
+        days[day] = [entry for start, entry in bucket]
+
+    writeOutput(data_directory + "/_days.json", json.dumps(days))
+
+def slugify(value):
+    """ A file name for value, of lower case letters, digits and dashes """
+    value = unicodedata.normalize("NFKD", str(value)).encode("ascii", "ignore").decode("ascii")
+    return re.sub(r"[^a-z0-9]+", "-", value.lower()).strip("-")
+
+def writeIcal(collected, stamps={}):
+    """
+    Writes data/all.ics, data/<source>.ics for every source and
+    data/tags/<tag>.ics for every tag set on sources in one pass, named by
+    slugify(). The events
+    of a source are serialized once and streamed to all feeds they are in.
+    """
+    tag_directory = data_directory + "/tags"
+    os.makedirs(tag_directory, exist_ok=True)
+    feeds = {}
+
+    def feed(filename, calname):
+        if filename not in feeds:
+            feeds[filename] = OutputStream(filename)
+            feeds[filename].write(icalHeader(calname))
+        return feeds[filename]
 
     try:
-        vevent.add("location", event["location"])
-    except KeyError:
-        pass
+        all_feed = feed(data_directory + "/all.ics", config.ICAL_CALNAME)
+        for source_name, source_config, events in collected:
+            title = source_config.get("title", source_name)
+            targets = [all_feed, feed("%s/%s.ics" % (data_directory, source_name),
+                                      "%s: %s" % (config.ICAL_CALNAME, title))]
+            tags = source_config.get("tags", [])
+            # a single tag may be given without a list
+            for tag in [tags] if isinstance(tags, str) else tags:
+                if not slugify(tag):
+                    logger.warning("Ignoring tag '%s' of source '%s'" % (tag, title))
+                    continue
+                target = feed("%s/%s.ics" % (tag_directory, slugify(tag)), "%s: %s" % (config.ICAL_CALNAME, tag))
+                # tags differing only in case or punctuation share a feed
+                if target not in targets:
+                    targets.append(target)
+
+            chunk = icalEvents(source_name, events, stamps)
+            for target in targets:
+                target.write(chunk)
+
+        for target in feeds.values():
+            target.write(ical_footer)
+    except BaseException:
+        for target in feeds.values():
+            target.abort()
+        raise
 
-    vevent.add("dtstart", datetime.strptime(event['start'], dt_format).replace(tzinfo=tz))
-    vevent.add("dtend", datetime.strptime(event['end'], dt_format).replace(tzinfo=tz))
+    for target in feeds.values():
+        target.close()
 
-    cal.add_component(vevent)
+    for filename in os.listdir(tag_directory):
+        if filename.endswith(".ics") and tag_directory + "/" + filename not in feeds:
+            removeOutput(tag_directory + "/" + filename)
 
-filename = directory + "/data/all.ics"
-f = open(filename, "w")
-f.buffer.write(cal.to_ical())
-f.close()
+def writeMetrics(metrics, seconds):
+    for source_name in metrics:
+        metrics[source_name].setdefault("stale", False)
+    run = {"seconds": seconds, "finished": time.time()}
+
+    outputs = [(metrics_file, json.dumps(dict(run, sources=metrics))),
+               (metrics_textfile, prometheusMetrics(metrics, run))]
+    for filename, content in outputs:
+        if not filename:
+            continue
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+            writeAtomic(filename, content.encode("utf-8"))
+        except OSError as e:
+            logger.error("Could not write metrics to %s: %s" % (filename, e))
+
+    # where earlier versions wrote them, for everyone to see
+    for filename in (data_directory + "/_metrics.json", data_directory + "/_metrics.prom"):
+        if filename not in (metrics_file, metrics_textfile):
+            removeOutput(filename)
+
+def run(sources):
+    """ Fetches the given sources and generates all output files from them """
+    start = time.monotonic()
+
+    source_state = loadSourceState()
+    fetched, metrics = fetchSources(sources, source_state)
+    collected = dedupEvents(collectEvents(sources, fetched, metrics, source_state))
+
+    writeFrontendSources(collected)
+    writeUpcoming(collected)
+    writeDays(collected)
+    writeIcal(collected, writeChanges(collected))
+    writeMetrics(metrics, time.monotonic() - start)
+
+    return collected
+
+def refreshInterval(source_config):
+    """ Seconds between two refreshes of a source in daemon mode """
+    return 60 * source_config.get("interval", refresh_interval)
+
+def daemon(sources):
+    """
+    Stays resident and refreshes every source on its own interval. After a
+    refresh the JSON files and shards of the refreshed sources are updated,
+    and the combined outputs only if the events of one of them changed.
+    """
+    collected = {}
+    merged = {}
+    metrics = {}
+    due = {source_name: 0 for source_name in sources}
+    day = None
+
+    while True:
+        now = time.monotonic()
+        refresh = {name: sources[name] for name, t in due.items() if t <= now}
+
+        if refresh:
+            # also when the refresh fails, it's tried again on the next interval
+            for source_name, source_config in refresh.items():
+                due[source_name] = now + refreshInterval(source_config)
+
+            try:
+                logger.info("Refreshing %s" % ", ".join(refresh))
+                source_state = loadSourceState()
+                fetched, refresh_metrics = fetchSources(refresh, source_state)
+
+                for source_name, source_config, events in collectEvents(refresh, fetched, refresh_metrics, source_state):
+                    collected[source_name] = (source_name, source_config, events)
+
+                metrics.update(refresh_metrics)
+
+                # in configured order, like a full run would write them. Merging
+                # duplicates can change sources that weren't refreshed, too.
+                ordered = dedupEvents([collected[name] for name in sources if name in collected])
+                changed = set(name for name, source_config, events in ordered if merged.get(name) != events)
+
+                if changed:
+                    writeFrontendSources(ordered, changed)
+                    writeIcal(ordered, writeChanges(ordered))
+                # only once written, a failed write is made again next time
+                merged = {name: events for name, source_config, events in ordered}
+
+                today = datetime.fromtimestamp(clock(), tz).date()
+                if changed or day != today:
+                    writeUpcoming(ordered)
+                    writeDays(ordered)
+                    day = today
+                writeMetrics(metrics, time.monotonic() - now)
+            except Exception:
+                logger.exception("Refreshing %s failed" % ", ".join(refresh))
+
+        time.sleep(max(1, min(due.values(), default=now + 60) - time.monotonic()))
+
+def main():
+    parser = ArgumentParser(description="Fetch all event sources and generate the calendar files")
+    parser.add_argument("--daemon", action="store_true",
+                        help="keep running and refresh every source on its own interval")
+    archive = parser.add_mutually_exclusive_group()
+    archive.add_argument("--record", metavar="DIR",
+                        help="keep every response of the sources in DIR, fetching everything anew")
+    archive.add_argument("--replay", metavar="DIR",
+                        help="run with the sources and responses recorded in DIR, without network access")
+    parser.add_argument("--output", metavar="DIR",
+                        help="where a replayed run writes its files, DIR/output of the archive by default")
+    args = parser.parse_args()
+    if args.daemon and (args.record or args.replay):
+        parser.error("--record and --replay make a single run")
+    if args.output and not args.replay:
+        parser.error("--output is only for --replay")
+
+    logging.basicConfig(format = '%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+            level=logging.INFO if args.daemon else logging.WARN)
+
+    sources = config.SOURCES
+    if args.record:
+        startRecording(args.record, sources)
+    elif args.replay:
+        sources = startReplay(args.replay, args.output)
+
+    sources = checkSources(sources)
+    if args.daemon:
+        daemon(sources)
+    else:
+        run(sources)
+
+if __name__ == "__main__":
+    main()
@@ -2,4 +2,4 @@
 
 cd "$( dirname "${BASH_SOURCE[0]}" )"
 . env/bin/activate
-python cron.py
+python cron.py "$@"
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# -------------------------------------------------------------
+#  Community Calendar
+#  Events as passed from the parsers to the writers
+# -------------------------------------------------------------
+
+from datetime import datetime, timedelta, time
+
+dt_format = "%Y-%m-%dT%H:%M:%S%z"
+
+def localTime(value, tz):
+    """
+    Returns value, a datetime, a date or an ISO 8601 string, as a timezone
+    aware datetime. Dates are at midnight, times without an offset in tz.
+    """
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    if not isinstance(value, datetime):
+        value = datetime.combine(value, time())
+    if value.tzinfo is None:
+        value = tz.localize(value)
+    return value
+
+class Event:
+    """
+    An event of a source. start and end are timezone aware datetimes, also
+    kept as seconds since the epoch in start_ts and end_ts. All day events
+    start at midnight local time and end at the midnight after their last day.
+    Events of a "multiple" source have the index of the feed they came from
+    in feed, which isn't written to the public files.
+    """
+    __slots__ = ("title", "start", "end", "start_ts", "end_ts", "all_day",
+                 "description", "location", "url", "uid", "feed")
+
+    # the fields other than the times, in the order they are written
+    fields = ("description", "location", "url", "uid")
+
+    def __init__(self, title, start, end, tz, all_day=False, description=None, location=None, url=None, uid=None,
+                 feed=None):
+        """
+        start and end are taken like localTime() does. Without an end, an
+        event takes an hour, or a day if it's an all day event.
+        """
+        start = localTime(start, tz)
+        if all_day:
+            # the day in the time zone the source gave, at midnight local time
+            start = localTime(start.date(), tz)
+            end = localTime(localTime(end, tz).date(), tz) if end is not None else start
+            if end <= start:
+                end = localTime(start.date() + timedelta(days = 1), tz)
+        else:
+            end = localTime(end, tz) if end is not None else start + timedelta(hours = 1)
+
+        self.title = title
+        self.start = start
+        self.end = end
+        self.start_ts = start.timestamp()
+        self.end_ts = end.timestamp()
+        self.all_day = bool(all_day)
+        self.description = description
+        self.location = location
+        self.url = url
+        self.uid = uid
+        self.feed = feed
+
+    @classmethod
+    def fromDict(cls, data, tz):
+        """ Reads an event written by toDict(), or kept by an older version """
+        return cls(data["title"], data["start"], data.get("end"), tz, all_day=data.get("allDay", False),
+                   feed=data.get("feed"), **{key: data[key] for key in cls.fields if data.get(key) is not None})
+
+    def toDict(self):
+        """ The event as written to the JSON files, times formatted with dt_format """
+        data = {
+            "title": self.title,
+            "start": self.start.strftime(dt_format),
+            "end": self.end.strftime(dt_format)
+        }
+        if self.all_day:
+            data["allDay"] = True
+        for key in self.fields:
+            value = getattr(self, key)
+            if value is not None:
+                data[key] = value
+        return data
+
+    def copy(self, **changes):
+        """ A copy of the event, with the fields other than the times changed """
+        event = Event.__new__(Event)
+        for key in self.__slots__:
+            setattr(event, key, changes.get(key, getattr(self, key)))
+        return event
+
+    def __eq__(self, other):
+        if not isinstance(other, Event):
+            return NotImplemented
+        return all(getattr(self, key) == getattr(other, key) for key in self.__slots__)
+
+    __hash__ = None
+
+    def __repr__(self):
+        return "<Event %r at %s>" % (self.title, self.start.strftime(dt_format))
@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# -------------------------------------------------------------
+#  Community Calendar
+#  Post the events DAYS_AHEAD days from now to social networks
+# -------------------------------------------------------------
+
+import json
+import sys
+import time
+import threading
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from argparse import ArgumentParser
+import logging
+
+from cron import config, data_directory, tz, cache_directory, readCacheFile, writeCacheFile
+
+logger = logging.getLogger(__name__)
+
+# How often a status is tried again after an error, and the longest rate
+# limit in seconds that is waited for instead of giving up on the status
+post_retries = getattr(config, "POST_RETRIES", 3)
+post_max_wait = getattr(config, "POST_MAX_WAIT", 900)
+
+# Statuses already posted are remembered for this many days, so running the
+# job again doesn't post them twice
+ledger_days = 7
+
+# -------------------------------------------------------------
+#  Backends
+# -------------------------------------------------------------
+
+backends = {}
+
+def backend(name):
+    """ Registers a function connecting to a social network under name """
+    def register(function):
+        backends[name] = function
+        return function
+    return register
+
+class RateLimited(Exception):
+    """ Raised by backends when they have to wait before posting again """
+    def __init__(self, wait):
+        Exception.__init__(self, "rate limited for %d seconds" % wait)
+        self.wait = wait
+
+@backend("twitter")
+def twitterBackend():
+    """ Returns a function posting a status to Twitter, or None if it isn't enabled """
+    if getattr(config, "TWITTER_ENABLED", False) != True:
+        return None
+
+    import tweepy
+
+    auth = tweepy.OAuthHandler(config.TWITTER_CONSUMER_KEY, config.TWITTER_CONSUMER_SECRET)
+    auth.set_access_token(config.TWITTER_ACCESS_KEY, config.TWITTER_ACCESS_SECRET)
+    api = tweepy.API(auth)
+
+    def post(status):
+        try:
+            api.update_status(status)
+        except tweepy.errors.TooManyRequests as e:
+            reset = int(e.response.headers.get("x-rate-limit-reset", 0))
+            raise RateLimited(max(reset - time.time(), 60))
+
+    return post
+
+@backend("mastodon")
+def mastodonBackend():
+    """ Returns a function posting a status to Mastodon, or None if it isn't enabled """
+    if getattr(config, "MASTODON_ENABLED", False) != True:
+        return None
+
+    from mastodon import Mastodon, MastodonRatelimitError
+
+    mastodon = Mastodon(
+        access_token = config.MASTODON_ACCESS_TOKEN,
+        api_base_url = config.MASTODON_URL,
+        ratelimit_method = "throw"
+    )
+
+    def post(status):
+        try:
+            mastodon.status_post(status)
+        except MastodonRatelimitError:
+            raise RateLimited(max(mastodon.ratelimit_reset - time.time(), 60))
+
+    return post
+
+# -------------------------------------------------------------
+#  Statuses
+# -------------------------------------------------------------
+
+def statusText(event):
+    max_length = 140 - 23 - 6 - 16 - len(event['source'])
+    if len(event['title']) > max_length:
+        title = u"%s..." % event['title'][:max_length-3]
+    else:
+        title = u"%s" % event['title']
+
+    if event.get("url"):
+        return u"%s: %s @ %s %s" % (event['start_text'], title, event['source'], event['url'])
+    elif event.get("website"):
+        return u"%s: %s @ %s %s" % (event['start_text'], title, event['source'], event['website'])
+    else:
+        return u"%s: %s @ %s" % (event['start_text'], title, event['source'])
+
+class DaysMissing(Exception):
+    """ Raised when the index of cron.py is missing or doesn't cover the day """
+
+def loadStatuses(day):
+    """
+    Returns (key, status) tuples for the events starting on day, from the
+    index written by cron.py. The key identifies the event in the ledger.
+    The index has every day from the one it was written on, a day that isn't
+    in it means cron.py hasn't run since.
+    """
+    filename = data_directory + "/_days.json"
+    try:
+        with open(filename) as data_file:
+            days = json.load(data_file)
+    except (OSError, ValueError) as e:
+        raise DaysMissing("could not read %s: %s" % (filename, e))
+    if day not in days:
+        raise DaysMissing("%s doesn't cover %s, it was written on %s"
+                % (filename, day, min(days, default="no day")))
+    events = days[day]
+
+    return [("%s|%s|%s" % (event["start"], event["source"], event["title"]), statusText(event))
+            for event in events]
+
+# -------------------------------------------------------------
+#  Ledger of posted statuses
+# -------------------------------------------------------------
+
+ledger_filename = cache_directory + "/posted.json"
+ledger_lock = threading.Lock()
+
+def loadLedger():
+    """ Returns a dict mapping backend names to the keys posted there and when """
+    try:
+        ledger = json.loads(readCacheFile(ledger_filename))
+    except (TypeError, ValueError):
+        return {}
+
+    horizon = time.time() - ledger_days * 24 * 3600
+    return {name: {key: t for key, t in posted.items() if t > horizon}
+            for name, posted in ledger.items()}
+
+def saveLedger(ledger):
+    writeCacheFile(ledger_filename, json.dumps(ledger).encode("utf-8"))
+
+# -------------------------------------------------------------
+#  Post
+# -------------------------------------------------------------
+
+def postStatuses(name, post, statuses, ledger):
+    """
+    Posts the statuses not in the ledger yet with one backend, in order.
+    Rate limits are waited for, up to POST_MAX_WAIT seconds, other errors
+    are retried with growing delays up to POST_RETRIES times.
+    """
+    with ledger_lock:
+        posted = ledger.setdefault(name, {})
+
+    for key, status in statuses:
+        if key in posted:
+            logger.info("already posted to %s: %s" % (name, status))
+            continue
+
+        logger.info("posting to %s (%s): %s" % (name, len(status), status))
+        for attempt in range(post_retries + 1):
+            try:
+                post(status)
+            except RateLimited as e:
+                if attempt == post_retries or e.wait > post_max_wait:
+                    logger.error("error posting to %s, %s: %s" % (name, e, status))
+                    break
+                logger.warning("%s is %s, waiting" % (name, e))
+                time.sleep(e.wait)
+            except Exception as e:
+                if attempt == post_retries:
+                    logger.error("error posting to %s, %s: %s" % (name, e, status))
+                    break
+                time.sleep(5 * 2 ** attempt)
+            else:
+                with ledger_lock:
+                    posted[key] = time.time()
+                    saveLedger(ledger)
+                break
+
+def postAll(statuses, names):
+    """ Posts the statuses to every enabled backend in names concurrently """
+    posters = {}
+    for name in names:
+        post = backends[name]()
+        if post is None:
+            logger.info("%s propagation not enabled." % name)
+        else:
+            posters[name] = post
+
+    ledger = loadLedger()
+    with ThreadPoolExecutor(max_workers=max(1, len(posters))) as executor:
+        futures = [executor.submit(postStatuses, name, post, statuses, ledger)
+                   for name, post in posters.items()]
+        for future in futures:
+            future.result()
+
+def main(argv=None):
+    parser = ArgumentParser(description="Post the events DAYS_AHEAD days from now")
+    parser.add_argument("backends", nargs="*",
+                        help="backends to post to (%s), all enabled ones by default" % ", ".join(sorted(backends)))
+    args = parser.parse_args(argv)
+    for name in args.backends:
+        if name not in backends:
+            parser.error("unknown backend '%s'" % name)
+
+    logging.basicConfig(filename='post.log',
+            format = '%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+
+    day = (datetime.now(tz).date() + timedelta(days=config.DAYS_AHEAD)).isoformat()
+    try:
+        statuses = loadStatuses(day)
+    except DaysMissing as e:
+        logger.error("not posting, %s" % e)
+        sys.exit("Not posting, %s" % e)
+    logger.debug("found %s events on %s" % (len(statuses), day))
+
+    postAll(statuses, args.backends or sorted(backends))
+
+if __name__ == "__main__":
+    main()